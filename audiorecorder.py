@@ -1,12 +1,501 @@
+import collections
+import numpy
 import pyaudio
 import wave
 import threading
+import time
+import os
+import shutil
+import tempfile
+
+# my modules
+import ringbuffer
+from clock import monotonic
+
+
+# numpy sample types matching the pyaudio sample formats
+SAMPLE_DTYPES = {
+    pyaudio.paInt16: numpy.int16,
+    pyaudio.paInt32: numpy.int32,
+    pyaudio.paFloat32: numpy.float32,
+}
+
+
+class StreamingWaveWriter():
+
+    # Appends audio chunks to a .wav file as they arrive. At most
+    # max_buffered_bytes are held in memory before being flushed to disk,
+    # and the header is patched once when the file is closed.
+    def __init__(self, filename, channels, sample_width, rate,
+                 max_buffered_bytes=256 * 1024):
+
+        self.filename = filename
+        self.max_buffered_bytes = max_buffered_bytes
+
+        self.waveFile = wave.open(filename, 'wb')
+        self.waveFile.setnchannels(channels)
+        self.waveFile.setsampwidth(sample_width)
+        self.waveFile.setframerate(rate)
+
+        self.buffered_chunks = []
+        self.buffered_bytes = 0
+
+
+    def write(self, data):
+        self.buffered_chunks.append(data)
+        self.buffered_bytes += len(data)
+
+        if self.buffered_bytes >= self.max_buffered_bytes:
+            self.flush()
+
+
+    def flush(self):
+        if not self.buffered_chunks:
+            return
+
+        # writeframesraw leaves the header alone, close() fixes it up
+        self.waveFile.writeframesraw(b''.join(self.buffered_chunks))
+        self.buffered_chunks = []
+        self.buffered_bytes = 0
+
+
+    def close(self):
+        self.flush()
+        self.waveFile.close()
+
+
+
+class SampleClock():
+
+    # Maps positions in the audio stream, in frames, to capture clock time
+    # and back, so the sample count can serve as the master clock.
+    #
+    # Every chunk adds an anchor: the position of its first frame and when
+    # that frame was captured. Anchors arrive late by a varying scheduling
+    # delay but never early, so the rate is a least-squares fit over the
+    # last anchors and the offset is taken from the earliest-arriving one.
+    # add() only appends, the fit runs on whoever calls fit().
+    def __init__(self, nominal_rate, max_anchors):
+        self.nominal_rate = nominal_rate
+        self.anchors = collections.deque(maxlen=max_anchors)
+
+        # (position, time, rate), replaced as a whole so readers on other
+        # threads always see a consistent model
+        self.model = None
+
+        # spread of the anchors around the fit, in seconds
+        self.jitter = 0.
+
+
+    def add(self, position, timestamp):
+        self.anchors.append((position, timestamp))
+        if self.model is None:
+            self.model = (position, timestamp, float(self.nominal_rate))
+
+
+    def fit(self):
+        anchors = numpy.array(list(self.anchors), dtype=numpy.float64)
+        if len(anchors) < 2:
+            return
+
+        base = anchors[0, 0]
+        positions = anchors[:, 0] - base
+        times = anchors[:, 1]
+        seconds_per_frame, intercept = numpy.polyfit(positions, times, 1)
+        if seconds_per_frame <= 0:
+            return
+
+        residuals = times - (intercept + seconds_per_frame * positions)
+        self.jitter = residuals.std()
+        self.model = (base, intercept + residuals.min(), 1. / seconds_per_frame)
+
+
+    def rate(self):
+        """Measured frames per second of capture clock, nominal until fitted"""
+        return self.model[2] if self.model is not None else float(self.nominal_rate)
+
+
+    def drift_ppm(self):
+        return (self.rate() / self.nominal_rate - 1.) * 1e6
+
+
+    def time_at(self, position):
+        """Capture clock time of a stream position, None before the first chunk"""
+        if self.model is None:
+            return None
+        base_position, base_time, rate = self.model
+        return base_time + (position - base_position) / rate
+
+
+    def position_at(self, timestamp):
+        """Stream position, fractional, captured at a capture clock time"""
+        if self.model is None:
+            return None
+        base_position, base_time, rate = self.model
+        return base_position + (timestamp - base_time) * rate
+
+
+
+# audio source that generates a sine tone instead of reading a microphone
+TONE_SOURCE = 'tone'
+
+
+class SyntheticStream():
+
+    # Stand-in for a callback-mode PyAudio input stream. A thread calls the
+    # stream callback with one chunk of generated samples per chunk of real
+    # time, for running the pipeline without a microphone.
+    def __init__(self, callback, dtype, channels, rate, chunk):
+        self.callback = callback
+        self.dtype = numpy.dtype(dtype)
+        self.channels = channels
+        self.rate = rate
+        self.chunk = chunk
+        self.position = 0
+        self.active = False
+
+
+    def next_chunk(self):
+        """The next chunk as a (chunk, channels) array, implemented by subclasses"""
+        raise NotImplementedError
+
+
+    def _run(self):
+        interval = float(self.chunk) / self.rate
+        next_tick = monotonic()
+        while self.active:
+            next_tick += interval
+            delay = next_tick - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            samples = self.next_chunk()
+            self.position += self.chunk
+            self.callback(samples.astype(self.dtype).tobytes(), self.chunk, {}, 0)
+
+
+    def start_stream(self):
+        self.active = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop_stream(self):
+        self.active = False
+        self.thread.join()
+
+
+    def close(self):
+        pass
+
+
+
+class ToneStream(SyntheticStream):
+
+    # Sine tone at frequency on every channel
+    def __init__(self, callback, dtype, channels, rate, chunk, frequency=440.):
+        SyntheticStream.__init__(self, callback, dtype, channels, rate, chunk)
+        self.frequency = frequency
+
+        self.amplitude = 0.3
+        if numpy.issubdtype(self.dtype, numpy.integer):
+            self.amplitude *= numpy.iinfo(self.dtype).max
+
+
+    def next_chunk(self):
+        t = (self.position + numpy.arange(self.chunk)) / float(self.rate)
+        wave_samples = self.amplitude * numpy.sin(2 * numpy.pi * self.frequency * t)
+        return numpy.repeat(wave_samples[:, numpy.newaxis], self.channels, axis=1)
+
+
+
+class WaveFileStream(SyntheticStream):
+
+    # Replays a .wav file with the stream's channels and sample format,
+    # starting over at the end
+    def __init__(self, callback, dtype, channels, rate, chunk, filepath):
+        SyntheticStream.__init__(self, callback, dtype, channels, rate, chunk)
+
+        waveFile = wave.open(filepath, 'rb')
+        if waveFile.getnchannels() != channels or waveFile.getsampwidth() != self.dtype.itemsize:
+            raise ValueError("%s does not match the stream format" % filepath)
+        data = waveFile.readframes(waveFile.getnframes())
+        waveFile.close()
+
+        self.samples = numpy.frombuffer(data, dtype=self.dtype).reshape(-1, channels)
+
+
+    def next_chunk(self):
+        indices = (self.position + numpy.arange(self.chunk)) % len(self.samples)
+        return self.samples[indices]
+
+
+
+def open_stream(source, callback, format, channels, rate, chunk):
+    """Open a synthetic input stream: TONE_SOURCE or a .wav file path"""
+
+    if source == TONE_SOURCE:
+        return ToneStream(callback, SAMPLE_DTYPES[format], channels, rate, chunk)
+    return WaveFileStream(callback, SAMPLE_DTYPES[format], channels, rate, chunk, source)
+
+
+
+class CaptureEngine():
+
+    # Callback-mode capture. PortAudio calls _callback from its own thread
+    # with every chunk, the samples are copied into a preallocated ring
+    # buffer and a consumer drains them with read() whenever it gets to it.
+    #
+    # source None is the default microphone, anything else is opened with
+    # open_stream instead of PortAudio.
+    def __init__(self, format=pyaudio.paInt16, channels=2, rate=44100,
+                 chunk=1024, buffer_seconds=10, source=None, clock_seconds=30):
+
+        self.source = source
+        self.format = format
+        self.channels = channels
+        self.rate = rate
+        self.chunk = chunk
+
+        self.ring = ringbuffer.RingBuffer(int(rate * buffer_seconds), channels,
+            dtype=SAMPLE_DTYPES[format])
+
+        # ring positions against capture time, over the last clock_seconds
+        self.clock = SampleClock(rate, int(clock_seconds * rate / chunk))
+
+        # times PortAudio itself reported that input was lost
+        self.input_overflows = 0
+
+        self.audio = None
+        self.stream = None
+
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+
+        # how long ago the chunk's first frame was captured, as PortAudio
+        # reports it when it can, otherwise the length of the chunk
+        latency = time_info.get('current_time', 0) - time_info.get('input_buffer_adc_time', 0)
+        if not 0 < latency < 1:
+            latency = float(frame_count) / self.rate
+        self.clock.add(self.ring.write_pos, monotonic() - latency)
+
+        samples = numpy.frombuffer(in_data, dtype=self.ring.buffer.dtype)
+        self.ring.write(samples.reshape(-1, self.channels))
+
+        return (None, pyaudio.paContinue)
+
+
+    def open(self):
+        if self.source is None:
+            self.audio = pyaudio.PyAudio()
+            self.stream = self.audio.open(format=self.format, channels=self.channels,
+                            rate=self.rate, input=True,
+                            frames_per_buffer=self.chunk,
+                            stream_callback=self._callback)
+        else:
+            self.stream = open_stream(self.source, self._callback, self.format,
+                self.channels, self.rate, self.chunk)
+        self.stream.start_stream()
+
+
+    def get_sample_size(self):
+        return pyaudio.get_sample_size(self.format)
+
+
+    def read(self):
+        """Drain everything captured since the last read as raw bytes"""
+        return self.ring.read().tobytes()
+
+
+    def wait(self):
+        """Sleep for about half a chunk, for consumers with nothing to read"""
+        time.sleep(0.5 * self.chunk / self.rate)
+
+
+    def overruns(self):
+        return self.ring.overruns + self.input_overflows
+
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        if self.audio is not None:
+            self.audio.terminate()
+
+
+
+class AudioDevice():
+
+    # Long-lived microphone. The capture engine is opened once, at app
+    # startup, and a consumer thread keeps draining it for as long as the
+    # app runs. A take never touches PortAudio: it attaches a writer at the
+    # current position of the live stream and detaches it again on stop.
+    #
+    # The last preroll_seconds of the stream are always kept around so a
+    # take can start slightly in the past.
+    def __init__(self, format=pyaudio.paInt16, channels=2, rate=44100, chunk=1024,
+                 preroll_seconds=2, source=None):
+
+        self.engine = CaptureEngine(format, channels, rate, chunk, source=source)
+        self.channels = channels
+        self.rate = rate
+        self.frame_bytes = self.engine.get_sample_size() * channels
+
+        # frames consumed from the live stream since open(), on the same
+        # scale as the clock's positions
+        self.position = 0
+        self.clock = self.engine.clock
+        self.last_fit = 0
+
+        # most recent chunks, at most preroll_frames frames plus one chunk
+        self.preroll_frames = int(preroll_seconds * rate)
+        self.history = collections.deque()
+        self.history_frames = 0
+
+        self.take_writer = None
+        self.take_preroll = None
+        self.take_start = 0
+        self.take_overruns = 0
+        self.last_take_overruns = 0
+        self.take_lock = threading.Lock()
+
+        self.running = False
+
+
+    def open(self):
+        if self.running:
+            return
+
+        self.engine.open()
+        self.running = True
+        self.consumer_thread = threading.Thread(target=self._consume)
+        self.consumer_thread.daemon = True
+        self.consumer_thread.start()
+
+
+    def _consume(self):
+        while self.running:
+            # refit the clock about once a second, off the callback thread
+            now = monotonic()
+            if now - self.last_fit >= 1:
+                self.clock.fit()
+                self.last_fit = now
+
+            # read under take_lock too, end_take drains the last of a take
+            # and the ring buffer takes one reader at a time
+            with self.take_lock:
+                data = self.engine.read()
+                if data:
+                    if self.take_writer is not None:
+                        self._write_preroll(self.take_writer)
+                        self.take_writer.write(data)
+                    self._advance(data)
+
+            if not data:
+                self.engine.wait()
+
+
+    # Writes the take's pre-roll ahead of its first live chunk, on the
+    # consumer thread rather than the one starting the take
+    def _write_preroll(self, writer):
+        if self.take_preroll is not None:
+            writer.write(self.take_preroll)
+            self.take_preroll = None
+
+
+    # Moves the stream position past data and remembers it for pre-roll
+    def _advance(self, data):
+        frames = len(data) // self.frame_bytes
+        self.position += frames
+
+        if not self.preroll_frames or not frames:
+            return
+
+        self.history.append(data)
+        self.history_frames += frames
+        while self.history_frames - len(self.history[0]) // self.frame_bytes >= self.preroll_frames:
+            self.history_frames -= len(self.history.popleft()) // self.frame_bytes
+
+
+    # The last `frames` frames of the stream as raw bytes, or less if the
+    # stream has not been running that long
+    def _recent(self, frames):
+        wanted = min(frames, self.history_frames) * self.frame_bytes
+        chunks = []
+        for data in reversed(self.history):
+            if wanted <= 0:
+                break
+            chunks.append(data[-wanted:] if len(data) > wanted else data)
+            wanted -= len(data)
+        return b''.join(reversed(chunks))
+
+
+    def get_sample_size(self):
+        return self.engine.get_sample_size()
+
+
+    def begin_take(self, writer, preroll_seconds=0):
+        """Start sending the live stream to writer, returns the start position
+
+        preroll_seconds -- start this far in the past, up to the device's
+                           own preroll_seconds
+
+        Returns right away, the pre-roll reaches writer from the consumer
+        thread.
+        """
+
+        with self.take_lock:
+            preroll = self._recent(int(preroll_seconds * self.rate))
+            self.take_preroll = preroll
+
+            self.take_writer = writer
+            self.take_start = self.position - len(preroll) // self.frame_bytes
+            self.take_overruns = self.engine.overruns()
+        return self.take_start
+
+
+    def end_take(self):
+        """Stop sending the live stream to the current writer
+
+        Returns the number of frames the take received.
+        """
+
+        with self.take_lock:
+            writer = self.take_writer
+            self.take_writer = None
+
+            # catch up with whatever was captured since the last drain
+            data = self.engine.read()
+            if writer is not None:
+                self._write_preroll(writer)
+                writer.write(data)
+            self._advance(data)
+
+        overruns = self.engine.overruns() - self.take_overruns
+        if overruns:
+            print "audio overruns during take: %d" % overruns
+        self.last_take_overruns = overruns
+
+        return self.position - self.take_start
+
+
+    def close(self):
+        self.running = False
+        self.consumer_thread.join()
+        self.engine.close()
+
+
 
 class AudioRecorder():
-    
-    # Audio class based on pyAudio and Wave
-    def __init__(self):
-        
+
+    # Audio class based on pyAudio and Wave. A take records from a shared,
+    # already open AudioDevice; without one it opens a private device for
+    # just this take.
+    def __init__(self, device=None):
+
         self.recording = False
 
         self.FORMAT = pyaudio.paInt16
@@ -14,68 +503,88 @@ class AudioRecorder():
         self.RATE = 44100
         self.CHUNK = 1024
         self.RECORD_SECONDS = 5
-        self.WAVE_OUTPUT_FILENAME = "file.wav"        
-
-        self.audio_frames = []
-
-    
-
-    # Audio starts being recorded
-    def _start_recording(self):
-        
-        self.audio = pyaudio.PyAudio()
-         
-        # start Recording
-        self.stream = self.audio.open(format=self.FORMAT, channels=self.CHANNELS,
-                        rate=self.RATE, input=True,
-                        frames_per_buffer=self.CHUNK)
-        
+        self.WAVE_OUTPUT_FILENAME = "file.wav"
+
+        self.device = device
+        self.owns_device = device is None
+
+        # chunks are streamed to a spool file while recording, and the
+        # spool file is renamed to WAVE_OUTPUT_FILENAME on stop
+        self.spool_filename = None
+
+        # frames written to the take and overruns while it recorded, known
+        # once it is finished
+        self.frame_count = 0
+        self.overruns = 0
+
+        # stream position of the take's first frame, once started
+        self.start_position = None
+
+
+
+    # Audio starts being recorded, preroll_seconds in the past if the
+    # device has kept that much. Raw chunks go to writer when one is given
+    # (anything with write and close), otherwise to a .wav file spooled in
+    # spool_dir, the system temp directory by default.
+    def start(self, preroll_seconds=0, writer=None, spool_dir=None):
+
+        if self.owns_device:
+            self.device = AudioDevice(self.FORMAT, self.CHANNELS, self.RATE, self.CHUNK)
+            self.device.open()
+
+        if writer is None:
+            spool_fd, self.spool_filename = tempfile.mkstemp(suffix='.wav', dir=spool_dir)
+            os.close(spool_fd)
+            writer = StreamingWaveWriter(self.spool_filename, self.device.channels,
+                self.device.get_sample_size(), self.device.rate)
+        self.writer = writer
+
+        self.recording = True
+        self.start_position = self.device.begin_take(self.writer, preroll_seconds)
+
         print "\nrecording...\n"
-        while self.recording == True:
-            data = self.stream.read(self.CHUNK)
-            self.audio_frames.append(data)
 
-            if self.recording == False:
-                break
-        
+
+
+    # Detaches the take from the live stream and closes the spool file
+    def _finish_recording(self):
+
+        self.recording = False
+        self.frame_count = self.device.end_take()
+        self.overruns = self.device.last_take_overruns
+
+        if self.owns_device:
+            self.device.close()
+
+        self.writer.close()
+
         print "\nfinished recording\n"
-        self._stop_recording()
-         
-         
-                
-    # Finishes the audio recording therefore the thread too    
-    def _stop_recording(self):
-        """ Stops audio recording and saves recording to a .wav file
-        
-        filename -- must specify .wav extension
+
+
+
+    def stop(self, filename=None):
+        """ Stops audio recording and moves the spooled recording to a .wav file
+
+        filename -- must specify .wav extension, unused with a custom writer
         """
 
-        # stop Recording
-        self.stream.stop_stream()
-        self.stream.close()
-        self.audio.terminate()
-         
-        waveFile = wave.open(self.WAVE_OUTPUT_FILENAME, 'wb')
-        waveFile.setnchannels(self.CHANNELS)
-        waveFile.setsampwidth(self.audio.get_sample_size(self.FORMAT))
-        waveFile.setframerate(self.RATE)
-        waveFile.writeframes(b''.join(self.audio_frames))
-        waveFile.close()
+        if not self.recording:
+            return
 
-        
-    
-    # Launches the audio recording function using a thread
-    def start(self):   
-        self.recording = True
-        audio_thread = threading.Thread(target=self._start_recording)
-        audio_thread.start()
+        self._finish_recording()
 
+        if self.spool_filename is not None:
+            self.WAVE_OUTPUT_FILENAME = filename
+
+            # a rename when the spool file is on the same filesystem
+            shutil.move(self.spool_filename, self.WAVE_OUTPUT_FILENAME)
 
-    def stop(self, filename):
-        self.WAVE_OUTPUT_FILENAME = filename
-        self.recording = False
 
     def cancel(self):
-        self.recording = False
-    
+        if not self.recording:
+            return
+
+        self._finish_recording()
 
+        if self.spool_filename is not None:
+            os.remove(self.spool_filename)
@@ -7,6 +7,9 @@ import time
 import subprocess
 import os
 
+# my modules
+import audiorecorder
+
 
 # In[ ]:
 
@@ -124,24 +127,22 @@ class AudioRecorder():
         self.channels = 2
         self.format = pyaudio.paInt16
         self.audio_filename = "videos/temp/temp_audio.wav"
-        self.audio = pyaudio.PyAudio()
-        self.stream = self.audio.open(format=self.format,
-                                      channels=self.channels,
-                                      rate=self.rate,
-                                      input=True,
-                                      frames_per_buffer = self.frames_per_buffer)
+        self.engine = audiorecorder.CaptureEngine(self.format, self.channels,
+                                                  self.rate, self.frames_per_buffer)
+        self.engine.open()
         self.audio_frames = []
+        self.audio_thread = None
 
 
     # Audio starts being recorded
     def record(self):
         
-        self.stream.start_stream()
         while(self.open == True):
-            data = self.stream.read(self.frames_per_buffer) 
-            self.audio_frames.append(data)
-            if self.open==False:
-                break
+            data = self.engine.read()
+            if data:
+                self.audio_frames.append(data)
+            else:
+                self.engine.wait()
         
             
     # Finishes the audio recording therefore the thread too    
@@ -149,13 +150,17 @@ class AudioRecorder():
        
         if self.open==True:
             self.open = False
-            self.stream.stop_stream()
-            self.stream.close()
-            self.audio.terminate()
+
+            # the ring buffer has one reader, the last read waits for
+            # the record thread to be done with its own
+            if self.audio_thread is not None:
+                self.audio_thread.join()
+            self.engine.close()
+            self.audio_frames.append(self.engine.read())
                
             waveFile = wave.open(self.audio_filename, 'wb')
             waveFile.setnchannels(self.channels)
-            waveFile.setsampwidth(self.audio.get_sample_size(self.format))
+            waveFile.setsampwidth(self.engine.get_sample_size())
             waveFile.setframerate(self.rate)
             waveFile.writeframes(b''.join(self.audio_frames))
             waveFile.close()
@@ -165,8 +170,8 @@ class AudioRecorder():
 
     # Launches the audio recording function using a thread
     def start(self):
-        audio_thread = threading.Thread(target=self.record)
-        audio_thread.start()
+        self.audio_thread = threading.Thread(target=self.record)
+        self.audio_thread.start()
 
 
     
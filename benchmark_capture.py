@@ -0,0 +1,99 @@
+# Runs the whole capture -> encode -> mux path without a camera, microphone
+# or display, and prints the per-stage metrics of the take. Everything the
+# take writes, journal and upload index included, goes to a temporary
+# directory, so the booth's own videos/ is never touched.
+#
+# Usage:
+#   python benchmark_capture.py --seconds 30 --backend videowriter
+#   python benchmark_capture.py --video recording.mp4 --audio recording.wav
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# no display needed
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtCore, QtWidgets
+
+# my modules
+import audiorecorder
+import capture
+import journal
+import videobooth
+import youtube_upload
+
+
+def use_output_dir(output_dir):
+    """Point the booth's temp, final and metrics directories into output_dir"""
+
+    for name in ('TEMPORARY_AUDIO_DIR', 'TEMPORARY_VIDEO_DIR', 'FINAL_AV_DIR', 'METRICS_DIR'):
+        directory = os.path.join(output_dir, os.path.basename(getattr(videobooth, name)))
+        os.makedirs(directory)
+        setattr(videobooth, name, directory)
+
+
+def run_take(device, seconds):
+    """Record one take of the given length, returns seconds from stop to a finished file"""
+
+    device.start()
+
+    # keep the event loop running so the preview path is exercised too
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        QtWidgets.QApplication.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+    stopped = time.time()
+    device.stop(wait=True)
+    return time.time() - stopped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10, help="Length of the take")
+    parser.add_argument("--warmup", type=float, default=3,
+        help="Seconds to run before the take starts, fills the pre-roll")
+    parser.add_argument("--video", default=capture.PATTERN_SOURCE,
+        help="Video source: 'pattern', a video file or a camera index")
+    parser.add_argument("--audio", default=audiorecorder.TONE_SOURCE,
+        help="Audio source: 'tone' or a .wav file")
+    parser.add_argument("--backend", default=videobooth.ENCODER_BACKEND,
+        choices=[videobooth.ENCODER_FFMPEG, videobooth.ENCODER_VIDEOWRITER])
+    parser.add_argument("--keep", action='store_true',
+        help="Keep the output directory instead of removing it")
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv)
+
+    output_dir = tempfile.mkdtemp(prefix='benchmark_capture_')
+    use_output_dir(output_dir)
+    session_journal = journal.Journal(os.path.join(output_dir, 'journal.sqlite3'))
+    upload_index = youtube_upload.UploadIndex(os.path.join(output_dir, 'upload_index.json'))
+
+    device = videobooth.CameraDevice(video_source=args.video, audio_source=args.audio,
+        session_journal=session_journal, upload_index=upload_index)
+    device.encoder_backend = args.backend
+    widget = videobooth.CameraWidget(device)
+    widget.show()
+
+    warmup_end = time.time() + args.warmup
+    while time.time() < warmup_end:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+    time_to_ready = run_take(device, args.seconds)
+
+    result = device.get_metrics()
+    result['time_to_ready_s'] = time_to_ready
+    result['final_file'] = device.get_final_filepath()
+    print json.dumps(result, indent=2, sort_keys=True)
+
+    device.release()
+    session_journal.close()
+
+    if args.keep:
+        print "output kept in " + output_dir
+    else:
+        shutil.rmtree(output_dir, ignore_errors=True)
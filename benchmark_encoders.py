@@ -0,0 +1,160 @@
+# Pushes synthetic frames through every available encoder path and reports
+# sustained fps, CPU time per frame and output bytes per second of video.
+#
+# Paths compared:
+#   opencv-<fourcc>    cv2.VideoWriter with that fourcc
+#   ffmpeg-<preset>    raw frames piped into ffmpeg's libx264 (encoders.FFmpegPipeEncoder)
+#   mjpeg-spool        every frame JPEG-encoded and appended to a spool file
+#
+# Usage:
+#   python benchmark_encoders.py
+#   python benchmark_encoders.py --sizes 1280x720 1920x1080 --rates 30 --seconds 10
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+
+# my modules
+import capture
+import encoders
+
+
+OPENCV_FOURCCS = ['mp4v', 'MJPG', 'XVID', 'avc1']
+FFMPEG_PRESETS = ['ultrafast', 'veryfast', 'medium']
+
+# distinct frames generated up front and cycled through, so the cost of
+# generating them is not measured
+DISTINCT_FRAMES = 30
+
+
+class MJPEGSpoolWriter():
+
+    # Appends each frame as a JPEG to one file, the cheapest thing that
+    # still compresses
+    def __init__(self, filename, quality=90):
+        self.spool = open(filename, 'wb')
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+
+    def write(self, frame):
+        ret, jpeg = cv2.imencode('.jpg', frame, self.params)
+        self.spool.write(jpeg.tobytes())
+
+
+    def release(self):
+        self.spool.close()
+
+
+
+def make_frames(frameSize):
+    source = capture.PatternSource(frameSize, fps=1e6)
+    return [source.read()[1] for i in range(DISTINCT_FRAMES)]
+
+
+def encoder_paths(available):
+    """(name, extension, factory) for each path, factory(filename, fps, frameSize)"""
+
+    paths = []
+    for fourcc in OPENCV_FOURCCS:
+        paths.append(('opencv-' + fourcc, '.avi' if fourcc in ('MJPG', 'XVID') else '.mp4',
+            lambda filename, fps, frameSize, fourcc=fourcc: cv2.VideoWriter(filename,
+                capture.fourcc(fourcc), fps, frameSize, True)))
+
+    if available['ffmpeg']:
+        for preset in FFMPEG_PRESETS:
+            paths.append(('ffmpeg-' + preset, '.mp4',
+                lambda filename, fps, frameSize, preset=preset: encoders.FFmpegPipeEncoder(
+                    filename, fps, frameSize, preset=preset, audio=False)))
+
+    paths.append(('mjpeg-spool', '.mjpeg',
+        lambda filename, fps, frameSize: MJPEGSpoolWriter(filename)))
+
+    return paths
+
+
+def cpu_seconds():
+    """CPU time of this process and of its finished children"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def run(name, factory, filename, frames, fps, frameSize, frame_count):
+
+    cpu_started = cpu_seconds()
+    started = time.time()
+
+    writer = factory(filename, fps, frameSize)
+    if hasattr(writer, 'isOpened') and not writer.isOpened():
+        return None
+
+    for i in range(frame_count):
+        writer.write(frames[i % len(frames)])
+
+    writer.release()
+    if hasattr(writer, 'wait'):
+        writer.wait()
+
+    elapsed = time.time() - started
+    cpu = cpu_seconds() - cpu_started
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    return {
+        'encoder': name,
+        'size': '%dx%d' % frameSize,
+        'fps': fps,
+        'frames': frame_count,
+        'sustained_fps': frame_count / elapsed,
+        'cpu_ms_per_frame': 1000. * cpu / frame_count,
+        'bytes_per_second': size / (float(frame_count) / fps),
+    }
+
+
+def parse_size(value):
+    w, h = value.lower().split('x')
+    return (int(w), int(h))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs='+', type=parse_size,
+        default=[(640, 480), (1280, 720), (1920, 1080)], help="Frame sizes, WxH")
+    parser.add_argument("--rates", nargs='+', type=int, default=[10, 30],
+        help="Frame rates the output is encoded at")
+    parser.add_argument("--seconds", type=float, default=5,
+        help="Seconds of video pushed through each path")
+    parser.add_argument("--json", action='store_true', help="Print results as json")
+    args = parser.parse_args()
+
+    available = {'ffmpeg': hasattr(os, 'mkfifo') and encoders.find_ffmpeg() is not None}
+
+    output_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for frameSize in args.sizes:
+            frames = make_frames(frameSize)
+            for fps in args.rates:
+                frame_count = int(args.seconds * fps)
+                for name, extension, factory in encoder_paths(available):
+                    filename = os.path.join(output_dir, name + extension)
+                    result = run(name, factory, filename, frames, fps, frameSize, frame_count)
+                    if result is None:
+                        print "%s is not available, skipping" % name
+                        continue
+                    results.append(result)
+                    if os.path.exists(filename):
+                        os.remove(filename)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print "%-18s %-10s %4s %10s %10s %12s" % (
+            'encoder', 'size', 'fps', 'sust. fps', 'cpu ms/f', 'bytes/s')
+        for r in results:
+            print "%-18s %-10s %4d %10.1f %10.2f %12d" % (r['encoder'], r['size'], r['fps'],
+                r['sustained_fps'], r['cpu_ms_per_frame'], r['bytes_per_second'])
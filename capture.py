@@ -0,0 +1,354 @@
+import collections
+import cv2
+import numpy
+import threading
+import time
+import Queue
+
+# my modules
+from clock import monotonic
+
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+# frame size (width, height) and frame rate of one stream
+Profile = collections.namedtuple('Profile', ['frameSize', 'fps'])
+
+# video source that generates a test pattern instead of reading a camera
+PATTERN_SOURCE = 'pattern'
+
+
+def fourcc(code):
+    """VideoWriter fourcc for a four character code, on OpenCV 2 and 3+"""
+    if hasattr(cv2, 'VideoWriter_fourcc'):
+        return cv2.VideoWriter_fourcc(*code)
+    return cv2.cv.FOURCC(*code)
+
+
+class Pacer():
+
+    # Sleeps so that successive calls to wait() are 1 / fps apart, the way
+    # a camera delivers frames
+    def __init__(self, fps):
+        self.interval = 1. / fps
+        self.next_tick = None
+
+
+    def wait(self):
+        now = monotonic()
+        if self.next_tick is None or now - self.next_tick > self.interval:
+            self.next_tick = now
+        elif self.next_tick > now:
+            time.sleep(self.next_tick - now)
+        self.next_tick += self.interval
+
+
+
+class PatternSource():
+
+    # Stand-in for cv2.VideoCapture that generates moving colour bars at
+    # the requested size and rate, for running the pipeline without a camera
+    def __init__(self, frameSize=(640, 480), fps=30):
+        self.frameSize = frameSize
+        self.pacer = Pacer(fps)
+        self.index = 0
+        self._make_bars()
+
+
+    def _make_bars(self):
+        w, h = self.frameSize
+        colors = numpy.array([[255, 255, 255], [0, 255, 255], [255, 255, 0], [0, 255, 0],
+                              [255, 0, 255], [0, 0, 255], [255, 0, 0], [0, 0, 0]], numpy.uint8)
+        columns = colors[numpy.arange(w) * len(colors) // w]
+        self.bars = numpy.ascontiguousarray(numpy.broadcast_to(columns, (h, w, 3)))
+
+
+    def set(self, prop, value):
+        if prop == 3:
+            self.frameSize = (int(value), self.frameSize[1])
+        elif prop == 4:
+            self.frameSize = (self.frameSize[0], int(value))
+        elif prop == 5:
+            self.pacer = Pacer(value)
+        else:
+            return False
+
+        if prop in (3, 4):
+            self._make_bars()
+        return True
+
+
+    def read(self):
+        self.pacer.wait()
+
+        w, h = self.frameSize
+        frame = numpy.roll(self.bars, self.index * 4, axis=1)
+
+        # a box moving down the frame, so dropped or repeated frames show
+        y = (self.index * 4) % max(h - 32, 1)
+        frame[y:y + 32, :32] = 255 - frame[y:y + 32, :32]
+
+        self.index += 1
+        return True, frame
+
+
+    def release(self):
+        pass
+
+
+
+class FileSource():
+
+    # Stand-in for cv2.VideoCapture that replays a video file at the rate
+    # it was recorded, starting over at the end
+    def __init__(self, filepath):
+        self.cap = cv2.VideoCapture(filepath)
+        self.pacer = Pacer(self.cap.get(5) or 30)
+
+
+    def set(self, prop, value):
+        # sizes and rates are whatever the file has
+        return False
+
+
+    def read(self):
+        self.pacer.wait()
+
+        ret, frame = self.cap.read()
+        if not ret:
+            self.cap.set(1, 0)
+            ret, frame = self.cap.read()
+        return ret, frame
+
+
+    def release(self):
+        self.cap.release()
+
+
+
+def open_source(source):
+    """Open a video source: a camera index, PATTERN_SOURCE or a video file path"""
+
+    if isinstance(source, int) or str(source).isdigit():
+        return cv2.VideoCapture(int(source))
+    if source == PATTERN_SOURCE:
+        return PatternSource()
+    return FileSource(source)
+
+
+class FrameQueue():
+
+    # Bounded hand-off between the capture thread and one consumer. When the
+    # consumer falls behind the queue never blocks the producer, it drops a
+    # frame instead: the oldest queued one (a preview only cares about the
+    # latest frame) or the incoming one (an encoder keeps what it has).
+    # on_drop is called with every item dropped or discarded, so pooled
+    # buffers find their way back.
+    def __init__(self, maxsize, drop=DROP_OLDEST, on_drop=None):
+
+        self.queue = Queue.Queue(maxsize)
+        self.drop = drop
+        self.dropped = 0
+        self.on_drop = on_drop
+
+
+    def _dropped(self, item):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+
+    def put(self, item):
+        """Queue item without blocking, returns False if a frame was dropped"""
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except Queue.Full:
+                if self.drop == DROP_NEWEST:
+                    self.dropped += 1
+                    self._dropped(item)
+                    return False
+
+            try:
+                self._dropped(self.queue.get_nowait())
+                self.dropped += 1
+            except Queue.Empty:
+                pass
+
+
+    def get(self, timeout=None):
+        """Next item, or None if nothing arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+    def get_latest(self):
+        """Most recent item, discarding older ones, or None if empty"""
+        item = None
+        while True:
+            try:
+                latest = self.queue.get_nowait()
+            except Queue.Empty:
+                return item
+
+            if item is not None:
+                self._dropped(item)
+            item = latest
+
+
+
+class FramePool():
+
+    # Fixed set of reusable frame buffers, so a consumer can convert into a
+    # buffer without allocating per frame. A buffer belongs to whoever
+    # acquired it until they release it, it is never handed out while held.
+    # Safe to acquire and release from different threads.
+    def __init__(self, size=3):
+        self.size = size
+        self.free = []
+        self.allocated = 0
+        self.lock = threading.Lock()
+
+
+    def acquire(self, shape, dtype=numpy.uint8):
+        """A free buffer of shape and dtype, or None if all are held"""
+
+        with self.lock:
+            while self.free:
+                buf = self.free.pop()
+                if buf.shape == shape and buf.dtype == dtype:
+                    return buf
+                # the size changed, let this one go
+                self.allocated -= 1
+
+            if self.allocated >= self.size:
+                return None
+            self.allocated += 1
+
+        return numpy.empty(shape, dtype=dtype)
+
+
+    def release(self, buf):
+        """Give back a buffer from acquire"""
+        with self.lock:
+            self.free.append(buf)
+
+
+
+class Consumer():
+
+    # One output of the capture thread. Frames are decimated to fps (None
+    # keeps them all) and passed through transform, both on the capture
+    # thread, before they are queued. A transform returning None drops the
+    # frame.
+    def __init__(self, frame_queue, fps=None, transform=None, name='consumer'):
+        self.name = name
+        self.frame_queue = frame_queue
+        self.fps = fps
+        self.transform = transform
+        self.next_due = None
+
+
+    def offer(self, timestamp, frame, metrics=None):
+        if self.fps:
+            interval = 1. / self.fps
+            if self.next_due is not None and timestamp < self.next_due - interval / 2:
+                return
+
+            # stay on the fps grid unless capture stalled for a whole frame
+            if self.next_due is None or timestamp - self.next_due > interval:
+                self.next_due = timestamp
+            self.next_due += interval
+
+        if self.transform is not None:
+            started = monotonic()
+            frame = self.transform(frame)
+            if metrics is not None:
+                metrics.record(self.name + '_transform', monotonic() - started)
+
+            if frame is None:
+                if metrics is not None:
+                    metrics.count(self.name + '_dropped')
+                return
+
+        if not self.frame_queue.put((timestamp, frame)) and metrics is not None:
+            metrics.count(self.name + '_dropped')
+
+
+
+class CaptureThread(threading.Thread):
+
+    # Owns the video source (see open_source). Every frame is stamped with
+    # the monotonic time it was read and offered to each consumer as a
+    # (timestamp, frame) pair. Stage latencies go to metrics (a
+    # metrics.PipelineMetrics) when one is set.
+    def __init__(self, source=0, frameSize=(640, 480), fps=10):
+        super(CaptureThread, self).__init__()
+        self.daemon = True
+
+        self.source = source
+        self.frameSize = frameSize
+        self.fps = fps
+
+        self.consumers = []
+        self.running = False
+        self.frame_counts = 0
+        self.metrics = None
+
+
+    def add_consumer(self, frame_queue, fps=None, transform=None, name='consumer'):
+        """Feed frame_queue at up to fps, returns frame_queue"""
+        self.consumers.append(Consumer(frame_queue, fps, transform, name))
+        return frame_queue
+
+
+    def run(self):
+        cap = open_source(self.source)
+        cap.set(3, self.frameSize[0])
+        cap.set(4, self.frameSize[1])
+        cap.set(5, self.fps)
+
+        interval = 1. / self.fps
+        next_frame = monotonic()
+
+        self.running = True
+        while self.running:
+            started = monotonic()
+            ret, frame = cap.read()
+            timestamp = monotonic()
+
+            metrics = self.metrics
+            if not ret:
+                if metrics is not None:
+                    metrics.count('read_failed')
+                time.sleep(interval)
+                continue
+
+            if metrics is not None:
+                metrics.record('read', timestamp - started)
+                metrics.frame_captured(timestamp)
+
+            self.frame_counts += 1
+            for consumer in self.consumers:
+                consumer.offer(timestamp, frame, metrics)
+
+            # hold the configured rate, cameras usually deliver faster
+            next_frame += interval
+            delay = next_frame - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = monotonic()
+
+        cap.release()
+
+
+    def stop(self):
+        self.running = False
+        self.join()
+
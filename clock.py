@@ -0,0 +1,72 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+
+# The capture clock: seconds from an arbitrary start that only ever move
+# forward at a steady rate, unlike time.time(), which an NTP step can move
+# by seconds mid-take. Frame timestamps, the audio sample clock's anchors
+# and all pacing are read from monotonic().
+#
+# time.monotonic only exists on python 3. On python 2 the operating
+# system's monotonic clock is read through ctypes: clock_gettime on posix
+# and QueryPerformanceCounter on Windows.
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    # CLOCK_MONOTONIC is 1 on linux and 6 on macOS
+    clock_id = 6 if sys.platform == 'darwin' else 1
+
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+        use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(clock_id, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    # fail here rather than on the first frame
+    monotonic()
+    return monotonic
+
+
+def _query_performance_counter():
+    kernel32 = ctypes.windll.kernel32
+
+    frequency = ctypes.c_int64()
+    if not kernel32.QueryPerformanceFrequency(ctypes.byref(frequency)):
+        raise OSError("QueryPerformanceFrequency failed")
+    frequency = float(frequency.value)
+
+    def monotonic():
+        counter = ctypes.c_int64()
+        kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+        return counter.value / frequency
+
+    return monotonic
+
+
+def _monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        if os.name == 'nt':
+            return _query_performance_counter()
+        return _clock_gettime()
+    except (OSError, AttributeError), e:
+        print "no monotonic clock (%s), timestamps follow the wall clock" % e
+        return time.time
+
+
+monotonic = _monotonic()
@@ -0,0 +1,313 @@
+import collections
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
+
+from distutils.spawn import find_executable
+
+# named pipes are only available on posix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# H.264/AAC settings of a final file. Quality is constant (crf) up to a
+# bitrate ceiling (maxrate, over a bufsize window), so a second of video
+# never takes more than maxrate. Keyframes come every gop_seconds in closed
+# GOPs.
+EncodeProfile = collections.namedtuple('EncodeProfile', ['preset', 'crf', 'maxrate', 'bufsize',
+    'h264_profile', 'level', 'gop_seconds', 'audio_bitrate', 'audio_rate'])
+
+ENCODE_PROFILES = {
+    # YouTube's recommended upload settings for 720p/1080p at 30 fps: High
+    # profile, 2 B-frames, closed GOPs of half a second, AAC-LC stereo at
+    # 384 kbps and 48 kHz. The preset keeps up with live capture.
+    'youtube': EncodeProfile(preset='veryfast', crf=21, maxrate='5M', bufsize='10M',
+        h264_profile='high', level='4.0', gop_seconds=0.5, audio_bitrate='384k', audio_rate=48000),
+
+    # about half the size, for a slow uplink
+    'compact': EncodeProfile(preset='veryfast', crf=24, maxrate='2500k', bufsize='5M',
+        h264_profile='high', level='4.0', gop_seconds=2, audio_bitrate='128k', audio_rate=48000),
+}
+DEFAULT_ENCODE_PROFILE = ENCODE_PROFILES['youtube']
+
+# bytes of encoded output copied into the final file at a time
+OUTPUT_CHUNKSIZE = 64 * 1024
+
+
+def find_ffmpeg():
+    """Path of the ffmpeg binary on the PATH, or None"""
+    return find_executable('ffmpeg')
+
+
+def encode_args(profile, key_seconds=None, audio=True):
+    """ffmpeg output arguments encoding video, and audio, with profile
+
+    key_seconds -- keyframe interval when it has to be shorter than the
+                   profile's own
+    """
+
+    if key_seconds is None or key_seconds > profile.gop_seconds:
+        key_seconds = profile.gop_seconds
+
+    args = ['-c:v', 'libx264', '-preset', profile.preset,
+        '-profile:v', profile.h264_profile, '-level', profile.level, '-pix_fmt', 'yuv420p',
+        '-crf', str(profile.crf), '-maxrate', profile.maxrate, '-bufsize', profile.bufsize,
+        '-force_key_frames', 'expr:gte(t,n_forced*%g)' % key_seconds,
+        '-flags', '+cgop', '-bf', '2']
+
+    if audio:
+        args += ['-c:a', 'aac', '-b:a', profile.audio_bitrate, '-ar', str(profile.audio_rate)]
+    return args
+
+
+def mux_command(audio_filepath, video_filepath, output_filepath, timescale=1., profile=None):
+    """ffmpeg arguments that mux audio and video into output in a single pass
+
+    With a profile (an EncodeProfile) the video is encoded with it, and
+    otherwise copied as is unless timescale is not 1. A timescale re-times
+    the video (2 plays it at half speed) with setpts in the same
+    decode/encode pass. The output has its index up front (faststart), so
+    it can be played and processed before it is completely downloaded.
+    """
+
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+        '-i', audio_filepath, '-i', video_filepath,
+        '-map', '1:v', '-map', '0:a']
+
+    if timescale != 1.:
+        cmd += ['-filter:v', 'setpts=%.6f*PTS' % timescale]
+
+    if profile is not None:
+        cmd += encode_args(profile)
+    elif timescale == 1.:
+        cmd += ['-c:v', 'copy', '-c:a', 'aac']
+    else:
+        cmd += ['-pix_fmt', 'yuv420p', '-c:v', 'libx264', '-c:a', 'aac']
+
+    cmd += ['-movflags', '+faststart', output_filepath]
+    return cmd
+
+
+
+class FFmpegPipeEncoder():
+
+    # Encodes a take straight into the final file. Raw frames go to a
+    # long-lived ffmpeg process over stdin and raw audio over a named pipe,
+    # so there is no intermediate file to decode again after stop.
+    #
+    # Frames are written with write() and release() like a cv2.VideoWriter,
+    # audio_writer (a FifoWriter) takes the raw sample chunks of an
+    # AudioDevice take without ever blocking. With audio=False only video is
+    # encoded and there is no audio_writer.
+    #
+    # Starting the encoder never waits on ffmpeg, it raises OSError right
+    # away if ffmpeg can't be run. Once ffmpeg exited, frames written are
+    # dropped and wait() returns its exit code.
+    #
+    # Encoding follows profile (an EncodeProfile), preset overrides its
+    # preset.
+    #
+    # With fragment_seconds the output is a fragmented MP4: every keyframe
+    # starts a self-contained fragment of interleaved audio and video, and
+    # keyframes come every fragment_seconds or the profile's gop_seconds,
+    # whichever is shorter. Everything before the last fragment is
+    # final as soon as it is written, so finishing the file costs the same
+    # for any length of take, and a crash leaves a playable file. The index
+    # of a fragmented file is at its start already. Otherwise the file is
+    # written with faststart, which moves the index up front after encoding.
+    #
+    # A fragmented file is only ever appended to, so ffmpeg writes it to
+    # stdout and a thread copies it into the file, hashing every byte on the
+    # way. sha256 is the file's hex digest once wait() returned, and None
+    # for a faststart file, which ffmpeg rewrites when it finishes.
+    def __init__(self, filename, fps, frameSize, audio_rate=44100, audio_channels=2,
+                 preset=None, audio=True, fragment_seconds=None,
+                 profile=DEFAULT_ENCODE_PROFILE):
+
+        self.filename = filename
+
+        if preset is not None:
+            profile = profile._replace(preset=preset)
+
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', '%dx%d' % frameSize, '-r', str(fps), '-i', 'pipe:0']
+
+        self.fifo_dir = None
+        if audio:
+            self.fifo_dir = tempfile.mkdtemp()
+            self.audio_fifo = os.path.join(self.fifo_dir, 'audio.pcm')
+            os.mkfifo(self.audio_fifo)
+
+            cmd += ['-f', 's16le', '-ar', str(audio_rate), '-ac', str(audio_channels),
+                '-i', self.audio_fifo,
+                '-map', '0:v', '-map', '1:a']
+
+        cmd += encode_args(profile, fragment_seconds, audio)
+
+        self.sha256 = None
+        self.output_thread = None
+        if fragment_seconds:
+            cmd += ['-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+                '-f', 'mp4', 'pipe:1']
+        else:
+            cmd += ['-movflags', '+faststart', filename]
+
+        print ' '.join(cmd)
+        try:
+            if fragment_seconds:
+                self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            else:
+                self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        except OSError:
+            if self.fifo_dir is not None:
+                shutil.rmtree(self.fifo_dir, ignore_errors=True)
+            raise
+        self.failed = False
+
+        if fragment_seconds:
+            self.output_thread = threading.Thread(target=self._write_output, name='encoder-output')
+            self.output_thread.daemon = True
+            self.output_thread.start()
+
+        self.audio_writer = None
+        if audio:
+            self.audio_writer = FifoWriter(self.audio_fifo, self.process)
+
+
+    def _write_output(self):
+        digest = hashlib.sha256()
+        fd = self.process.stdout.fileno()
+        with open(self.filename, 'wb') as f:
+            while True:
+                data = os.read(fd, OUTPUT_CHUNKSIZE)
+                if not data:
+                    break
+                f.write(data)
+                digest.update(data)
+        self.sha256 = digest.hexdigest()
+
+
+    def write(self, frame):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except IOError, e:
+            print "ffmpeg stopped taking frames: %s" % e
+            self.failed = True
+
+
+    def release(self):
+        """No more frames, the audio writer is closed by its take"""
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+
+
+    def wait(self):
+        """Block until the final file is written, returns ffmpeg's exit code"""
+
+        self.release()
+        if self.audio_writer is not None:
+            self.audio_writer.close()
+            self.audio_writer.join()
+
+        returncode = self.process.wait()
+        if self.output_thread is not None:
+            self.output_thread.join()
+        if self.fifo_dir is not None:
+            shutil.rmtree(self.fifo_dir, ignore_errors=True)
+        return returncode
+
+
+
+class FifoWriter():
+
+    # Feeds a named pipe from a thread of its own. write() only queues the
+    # data, the thread opens the pipe once the reader gets round to opening
+    # it and then writes everything queued, so a writer never blocks on the
+    # pipe. ffmpeg opens its inputs in order, the audio pipe only after the
+    # first video frame arrived.
+    #
+    # Data for a reader that exited, before or after opening the pipe, is
+    # dropped.
+    def __init__(self, filepath, process):
+        self.filepath = filepath
+        self.process = process
+        self.queue = Queue.Queue()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name='encoder-audio')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _open(self):
+        """The pipe opened for writing, None if the reader exited first"""
+
+        while True:
+            try:
+                fd = os.open(self.filepath, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if self.process.poll() is not None:
+                    return None
+                time.sleep(0.01)
+
+        # writes should block like a regular pipe from here on
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb')
+
+
+    def _run(self):
+        try:
+            pipe = self._open()
+        except OSError, e:
+            print "could not open %s: %s" % (self.filepath, e)
+            pipe = None
+
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if pipe is None:
+                continue
+            try:
+                pipe.write(data)
+            except IOError, e:
+                print "audio pipe closed by the reader: %s" % e
+                pipe.close()
+                pipe = None
+
+        if pipe is not None:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+
+    def write(self, data):
+        if not self.closed:
+            self.queue.put(data)
+
+
+    def close(self):
+        """No more data, the pipe is closed once everything queued is written"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+
+
+    def join(self):
+        self.thread.join()
@@ -0,0 +1,52 @@
+import json
+import os
+
+
+def replace_file(source, target):
+    """Rename source to target, replacing target if it exists
+
+    os.rename does that on posix, on Windows python 2 it refuses to, so the
+    target is removed first there. A crash in between leaves no target and
+    source in place.
+    """
+
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+def write_synced(filepath, data):
+    """Write the string data to filepath and wait until it is on disk"""
+
+    with open(filepath, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_json(filepath, data):
+    """Replace filepath with data as json, a crash or power cut at any point
+    leaves either the old or the new file
+    """
+
+    write_synced(filepath + '.tmp', json.dumps(data))
+    replace_file(filepath + '.tmp', filepath)
+
+
+def read_json(filepath, default=None):
+    """Data of a json file, or default if there is none
+
+    A file that can't be parsed, e.g. one cut short by a power cut, is set
+    aside as .corrupt for a person to look at and default is returned.
+    """
+
+    if not os.path.exists(filepath):
+        return default
+
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except ValueError, e:
+        print "%s is unreadable (%s), setting it aside as .corrupt" % (filepath, e)
+        replace_file(filepath, filepath + '.corrupt')
+        return default
@@ -0,0 +1,277 @@
+import itertools
+import os
+import threading
+import time
+import Queue
+
+
+# lower numbers run first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+def lower_priority():
+    """preexec_fn for background child processes, so live capture wins the CPU"""
+    os.nice(10)
+
+
+# extra subprocess arguments for background work like post-processing
+BACKGROUND_POPEN_KWARGS = {'preexec_fn': lower_priority} if os.name == 'posix' else {}
+
+
+class Cancelled(Exception):
+    pass
+
+
+
+class Job():
+
+    # One piece of queued work and, once it ran, its result or error. A
+    # job cancelled before it started never runs and ends with Cancelled.
+    def __init__(self, name, fn, args, kwargs, priority):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+
+    def run(self):
+        try:
+            if self.cancelled:
+                raise Cancelled()
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception, e:
+            self.error = e
+            if not isinstance(e, Cancelled):
+                print "job %s failed: %r" % (self.name, e)
+        finally:
+            with self.lock:
+                self.done.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                self._call(callback)
+
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            print "callback of job %s failed: %r" % (self.name, e)
+
+
+    def add_done_callback(self, callback):
+        """Call callback(job) on the worker once the job ran, or now if it has"""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        self._call(callback)
+
+
+    def cancel(self):
+        """Keep the job from starting, work that checks job.cancelled stops early"""
+        self.cancelled = True
+
+
+    def wait(self, timeout=None):
+        """Block until the job ran, returns False on timeout"""
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+
+class JobQueue():
+
+    # Bounded priority queue drained by a fixed pool of worker threads.
+    # submit() refuses work with Queue.Full once maxsize jobs are waiting,
+    # so callers see backpressure instead of piling up threads. Work that
+    # can't be refused goes through submit_later(), which holds it aside
+    # until there is room.
+    def __init__(self, name, workers=1, maxsize=4):
+        self.name = name
+        self.queue = Queue.PriorityQueue(maxsize)
+
+        # ties in priority run oldest first, then in submission order
+        self.sequence = itertools.count()
+
+        self.running = 0
+        self.completed = 0
+
+        # jobs of submit_later() waiting for room in the queue
+        self.overflow = 0
+        self.lock = threading.Lock()
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='%s-%d' % (name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def _work(self):
+        while True:
+            priority, created, sequence, job = self.queue.get()
+            if job is None:
+                return
+
+            with self.lock:
+                self.running += 1
+            job.run()
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs), returns its Job
+
+        priority -- PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        created -- time.time() the work came about, for ordering by age,
+                   defaults to now
+        block -- wait for room instead of raising Queue.Full
+        """
+
+        priority = kwargs.pop('priority', PRIORITY_NORMAL)
+        created = kwargs.pop('created', None)
+        block = kwargs.pop('block', False)
+
+        job = Job(getattr(fn, '__name__', self.name), fn, args, kwargs, priority)
+        return self.put(job, created, block)
+
+
+    def put(self, job, created=None, block=False):
+        """Queue an already made Job, takes created and block like submit()"""
+
+        if created is None:
+            created = time.time()
+
+        self.queue.put((job.priority, created, next(self.sequence), job), block)
+        return job
+
+
+    def submit_later(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) like submit(), returns its Job right away
+
+        Never blocks or raises Queue.Full: without room, the job is queued
+        from a thread of its own as soon as there is.
+        """
+
+        priority = kwargs.pop('priority', PRIORITY_NORMAL)
+        created = kwargs.pop('created', None)
+
+        job = Job(getattr(fn, '__name__', self.name), fn, args, kwargs, priority)
+        return self.put_later(job, created)
+
+
+    def put_later(self, job, created=None):
+        """Queue an already made Job like submit_later(), never blocks"""
+
+        if created is None:
+            created = time.time()
+
+        try:
+            return self.put(job, created)
+        except Queue.Full:
+            pass
+
+        with self.lock:
+            self.overflow += 1
+        thread = threading.Thread(target=self._put_overflow, args=(job, created),
+            name='%s-overflow' % self.name)
+        thread.daemon = True
+        thread.start()
+        return job
+
+
+    def _put_overflow(self, job, created):
+        try:
+            self.put(job, created, True)
+        finally:
+            with self.lock:
+                self.overflow -= 1
+
+
+    def depth(self):
+        """Jobs waiting to run"""
+        return self.queue.qsize() + self.overflow
+
+
+    def full(self):
+        """Whether new work would have to wait for room"""
+        return self.queue.full() or self.overflow > 0
+
+
+    def shutdown(self):
+        """Let queued jobs finish, then stop the workers"""
+        for worker in self.workers:
+            self.queue.put((PRIORITY_LOW + 1, 0, next(self.sequence), None))
+        for worker in self.workers:
+            worker.join()
+
+
+
+class TokenBucket():
+
+    # Allows rate events per second on average and bursts of up to burst.
+    # take() blocks until a token is available, from any number of threads.
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+class JobScheduler():
+
+    # Background work of the booth: a small pool for post-processing takes
+    # and a separate one for uploads and other network I/O, so a slow
+    # upload never holds up the next take's file.
+    #
+    # The CPU-heavy part of post-processing runs in ffmpeg child processes,
+    # started with BACKGROUND_POPEN_KWARGS, so the workers themselves are
+    # threads that mostly wait and stay out of the way of the GIL.
+    def __init__(self, postprocess_workers=1, upload_workers=2,
+                 postprocess_maxsize=3, upload_maxsize=8):
+
+        self.postprocess = JobQueue('postprocess', postprocess_workers, postprocess_maxsize)
+        self.uploads = JobQueue('upload', upload_workers, upload_maxsize)
+
+
+    def status(self):
+        """One line of queue depths for the UI"""
+        return "Processing: %d running, %d queued | Uploads: %d running, %d queued" % (
+            self.postprocess.running, self.postprocess.depth(),
+            self.uploads.running, self.uploads.depth())
+
+
+    def shutdown(self):
+        self.postprocess.shutdown()
+        self.uploads.shutdown()
+
@@ -0,0 +1,138 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+JOURNAL_FILEPATH = 'videos/journal.sqlite3'
+
+# states of a session, in the order a take goes through them
+RECORDING = 'recording'     # take is being recorded
+RECORDED = 'recorded'       # recording stopped, final file not written yet
+PROCESSED = 'processed'     # final file written
+UPLOADED = 'uploaded'       # on YouTube, youtube_id is set
+NOTIFIED = 'notified'       # Node server told about the upload
+
+# states a session can end in early
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    encoder_backend TEXT,
+    temp_audio TEXT,
+    temp_video TEXT,
+    final_video TEXT,
+    timescale REAL,
+    metadata TEXT,
+    youtube_id TEXT
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    session_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    at REAL NOT NULL
+);
+"""
+
+# session columns that transition() may update
+FIELDS = ('encoder_backend', 'temp_audio', 'temp_video', 'final_video',
+          'timescale', 'metadata', 'youtube_id')
+
+
+class Journal():
+
+    # Durable record of every session's progress through the states above.
+    # Each transition is committed before the call returns, so after a
+    # crash the journal says exactly which steps a session still needs.
+    def __init__(self, filepath=JOURNAL_FILEPATH):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+
+        # shared by the GUI thread and the job workers, under self.lock
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+
+    def begin(self, session_id, **fields):
+        """Record a new session in the RECORDING state"""
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO sessions (id, state, created, updated) VALUES (?, ?, ?, ?)",
+                (session_id, RECORDING, now, now))
+            self.connection.execute(
+                "INSERT INTO transitions (session_id, state, at) VALUES (?, ?, ?)",
+                (session_id, RECORDING, now))
+            self._update(session_id, fields)
+            self.connection.commit()
+
+
+    def transition(self, session_id, state=None, **fields):
+        """Move a session to state (None keeps it) and update fields
+
+        metadata is given as a dict and stored as json.
+        """
+
+        now = time.time()
+        with self.lock:
+            if state is not None:
+                self.connection.execute(
+                    "UPDATE sessions SET state = ?, updated = ? WHERE id = ?",
+                    (state, now, session_id))
+                self.connection.execute(
+                    "INSERT INTO transitions (session_id, state, at) VALUES (?, ?, ?)",
+                    (session_id, state, now))
+            self._update(session_id, fields)
+            self.connection.commit()
+
+
+    def _update(self, session_id, fields):
+        for name, value in fields.items():
+            if name not in FIELDS:
+                raise ValueError("Unknown session field %s" % name)
+            if name == 'metadata':
+                value = json.dumps(value)
+            self.connection.execute(
+                "UPDATE sessions SET %s = ? WHERE id = ?" % name, (value, session_id))
+
+
+    def _session(self, row):
+        session = dict(zip(row.keys(), row))
+        if session['metadata'] is not None:
+            session['metadata'] = json.loads(session['metadata'])
+        return session
+
+
+    def get(self, session_id):
+        """The session as a dict, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return self._session(row) if row is not None else None
+
+
+    def incomplete(self):
+        """Sessions that stopped short of a final state, oldest first
+
+        A processed session only counts when an upload was requested for it.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM sessions WHERE state IN (?, ?, ?) "
+                "OR (state = ? AND metadata IS NOT NULL) ORDER BY created",
+                (RECORDING, RECORDED, UPLOADED, PROCESSED)).fetchall()
+        return [self._session(row) for row in rows]
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
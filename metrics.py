@@ -0,0 +1,139 @@
+import bisect
+import json
+import math
+
+# my modules
+from clock import monotonic
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKET_BOUNDS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+
+
+class Histogram():
+
+    # Fixed-bucket latency histogram. Recording a value is a bisect and a few
+    # additions, cheap enough for every frame on every stage.
+    def __init__(self):
+        self.buckets = [0] * len(BUCKET_BOUNDS_MS)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in ms"""
+
+        if not self.count:
+            return None
+
+        rank = p / 100. * self.count
+        seen = 0
+        for bound, n in zip(BUCKET_BOUNDS_MS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': dict((str(bound), n) for bound, n in zip(BUCKET_BOUNDS_MS, self.buckets) if n),
+        }
+
+
+
+class Jitter():
+
+    # Running mean and standard deviation of the intervals between
+    # successive timestamps (Welford's algorithm)
+    def __init__(self):
+        self.last = None
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+
+    def add(self, timestamp):
+        if self.last is not None:
+            interval = (timestamp - self.last) * 1000.
+            self.count += 1
+            delta = interval - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (interval - self.mean)
+        self.last = timestamp
+
+
+    def summary(self):
+        stddev = math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.
+        return {'intervals': self.count, 'mean_interval_ms': self.mean, 'jitter_ms': stddev}
+
+
+
+class PipelineMetrics():
+
+    # Per-stage latencies, counters and capture jitter for one take. Each
+    # stage is only ever recorded from one thread, so nothing is locked.
+    def __init__(self):
+        self.started = monotonic()
+        self.stopped = None
+        self.stages = {}
+        self.counters = {}
+        self.jitter = Jitter()
+
+
+    def record(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.add(seconds * 1000.)
+
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def frame_captured(self, timestamp):
+        self.jitter.add(timestamp)
+
+
+    def stop(self):
+        """End the duration here, later stages like post-processing don't count"""
+        if self.stopped is None:
+            self.stopped = monotonic()
+
+
+    def summary(self):
+        return {
+            'duration_s': (self.stopped or monotonic()) - self.started,
+            'stages': dict((stage, h.summary()) for stage, h in self.stages.items()),
+            'counters': dict(self.counters),
+            'capture': self.jitter.summary(),
+        }
+
+
+    def dump(self, filepath, **extra):
+        """Write the summary, plus any extra fields, to filepath as json"""
+
+        data = self.summary()
+        data.update(extra)
+        with open(filepath, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
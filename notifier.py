@@ -0,0 +1,225 @@
+# Tells the Node server about uploaded videos. Payloads are written to an
+# on-disk outbox first and a background thread posts them, so a slow or
+# unreachable server never holds up an upload and nothing is lost on a crash.
+#
+# For testing without the real server, run a local stand-in and point the
+# booth at it:
+#   python notifier.py --serve 8000
+#   VIDEOBOOTH_NOTIFY_URL=http://localhost:8000/upload python videobooth.py
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# my modules
+from files import replace_file, write_synced
+
+
+NOTIFY_URL = os.environ.get('VIDEOBOOTH_NOTIFY_URL', 'https://mitpeople.herokuapp.com/upload')
+OUTBOX_DIR = 'videos/outbox'
+
+# seconds to connect and to wait for a response
+TIMEOUT = (3.05, 10)
+
+# seconds between flushes after failures, doubling up to the maximum
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+
+HEADERS = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+
+
+class Notifier():
+
+    # Durable outbox of payloads for the Node server's /upload endpoint.
+    # put() writes a payload to its own file in outbox_dir and returns; a
+    # flusher thread posts waiting payloads oldest first, up to batch_size
+    # per flush over one pooled keep-alive connection, and removes each
+    # once the server took it. A failed flush backs off exponentially.
+    #
+    # Payloads the server rejects outright (4xx) are renamed to .rejected
+    # and left for a person to look at.
+    def __init__(self, url=NOTIFY_URL, outbox_dir=OUTBOX_DIR, batch_size=10, timeout=TIMEOUT):
+        self.url = url
+        self.outbox_dir = outbox_dir
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        if not os.path.isdir(outbox_dir):
+            os.makedirs(outbox_dir)
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        self.backoff = 0
+        self.sent = 0
+        self.wakeup = threading.Event()
+
+        # payloads in the outbox, kept up to date by put() and flush() so
+        # status() never has to look at the directory
+        self.lock = threading.Lock()
+        self.waiting = len(self.pending())
+
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_forever, name='notifier')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def put(self, key, payload):
+        """Queue payload for the server, a payload with the same key replaces it"""
+
+        filepath = os.path.join(self.outbox_dir, '%s.json' % key)
+
+        # written aside, synced and renamed, so neither the flusher nor a
+        # restart after a power cut ever sees half a file
+        write_synced(filepath + '.tmp', json.dumps({'queued': time.time(), 'payload': payload}))
+        with self.lock:
+            if not os.path.exists(filepath):
+                self.waiting += 1
+            replace_file(filepath + '.tmp', filepath)
+
+        self.wakeup.set()
+
+
+    def pending(self):
+        """Outbox files waiting to be sent, oldest first"""
+
+        entries = []
+        for filename in os.listdir(self.outbox_dir):
+            if filename.endswith('.json'):
+                filepath = os.path.join(self.outbox_dir, filename)
+                try:
+                    entries.append((os.path.getmtime(filepath), filepath))
+                except OSError:
+                    # sent or rejected since it was listed
+                    pass
+        return [filepath for mtime, filepath in sorted(entries)]
+
+
+    def flush(self):
+        """Post up to batch_size waiting payloads, returns False if the server failed"""
+
+        for filepath in self.pending()[:self.batch_size]:
+            try:
+                with open(filepath) as f:
+                    payload = json.load(f)['payload']
+            except (ValueError, KeyError), e:
+                print "%s is unreadable (%s), keeping it as .rejected" % (filepath, e)
+                self._set_aside(filepath)
+                continue
+
+            try:
+                r = self.session.post(self.url, data=json.dumps(payload), timeout=self.timeout)
+            except requests.RequestException, e:
+                print "notifying %s failed: %s" % (self.url, e)
+                return False
+
+            if 400 <= r.status_code < 500 and r.status_code not in (408, 429):
+                print "server rejected %s with %d, keeping it as .rejected" % (filepath, r.status_code)
+                self._set_aside(filepath)
+            elif r.status_code >= 300:
+                print "notifying %s failed with %d" % (self.url, r.status_code)
+                return False
+            else:
+                with self.lock:
+                    os.remove(filepath)
+                    self.waiting -= 1
+                self.sent += 1
+        return True
+
+
+    def _set_aside(self, filepath):
+        with self.lock:
+            replace_file(filepath, filepath[:-len('.json')] + '.rejected')
+            self.waiting -= 1
+
+
+    def _flush_forever(self):
+        while self.running:
+            try:
+                flushed = self.flush()
+            except Exception, e:
+                # the thread has to survive anything, or nothing is ever
+                # sent again
+                print "flushing the outbox failed: %r" % e
+                flushed = False
+
+            if flushed:
+                self.backoff = 0
+                # more may be waiting than one batch
+                if self.pending():
+                    continue
+                self.wakeup.wait()
+            else:
+                self.backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, 2 * self.backoff))
+                self.wakeup.wait(self.backoff * random.uniform(0.5, 1))
+            self.wakeup.clear()
+
+
+    def status(self):
+        if not self.waiting:
+            return "Notifications: %d sent" % self.sent
+        return "Notifications: %d sent, %d waiting" % (self.sent, self.waiting)
+
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.session.close()
+
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Accepts what the Node server's /upload endpoint accepts and prints
+    # it. With fail_rate set on the server, answers that share of requests
+    # with a 503 to exercise the backoff.
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        if random.random() < self.server.fail_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        print "%s %s" % (self.path, json.dumps(payload, sort_keys=True))
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        self.wfile.write('OK')
+
+
+
+def serve(port, fail_rate=0.):
+    server = BaseHTTPServer.HTTPServer(('localhost', port), StandInHandler)
+    server.fail_rate = fail_rate
+    print "stand-in Node server on http://localhost:%d/upload" % port
+    server.serve_forever()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", type=int, metavar='PORT', required=True,
+        help="Run a local stand-in for the Node server on PORT")
+    parser.add_argument("--fail-rate", type=float, default=0.,
+        help="Share of requests the stand-in answers with 503")
+    args = parser.parse_args()
+
+    serve(args.serve, args.fail_rate)
@@ -0,0 +1,75 @@
+import numpy
+
+
+class RingBuffer():
+
+    # Preallocated single-producer / single-consumer ring of sample frames.
+    #
+    # The producer only ever advances write_pos and the consumer only ever
+    # advances read_pos, so neither side needs a lock: each position is a
+    # plain attribute that the other side just reads. Positions count frames
+    # since the buffer was created and are never wrapped, the index into the
+    # array is the position modulo the capacity.
+    def __init__(self, capacity, channels, dtype=numpy.int16):
+
+        self.capacity = capacity
+        self.channels = channels
+        self.buffer = numpy.zeros((capacity, channels), dtype=dtype)
+
+        self.write_pos = 0
+        self.read_pos = 0
+
+        # frames the producer had to throw away because the consumer fell behind
+        self.overruns = 0
+        self.dropped_frames = 0
+
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+
+    def free(self):
+        return self.capacity - self.available()
+
+
+    def _copy_in(self, pos, samples):
+        start = pos % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+
+
+    def _copy_out(self, pos, count):
+        start = pos % self.capacity
+        first = min(count, self.capacity - start)
+        if first == count:
+            return self.buffer[start:start + count].copy()
+        return numpy.concatenate((self.buffer[start:], self.buffer[:count - first]))
+
+
+    def write(self, samples):
+        """Producer side, appends as many frames as fit and returns that count"""
+
+        count = min(len(samples), self.free())
+        if count < len(samples):
+            self.overruns += 1
+            self.dropped_frames += len(samples) - count
+
+        if count:
+            self._copy_in(self.write_pos, samples[:count])
+            self.write_pos += count
+
+        return count
+
+
+    def read(self, max_frames=None):
+        """Consumer side, returns a copy of the unread frames (possibly empty)"""
+
+        count = self.available()
+        if max_frames is not None:
+            count = min(count, max_frames)
+
+        data = self._copy_out(self.read_pos, count)
+        self.read_pos += count
+        return data
+
@@ -2,27 +2,75 @@
 from PyQt5 import QtGui, QtCore, QtWidgets
 
 
+import collections
 import cv2
 import datetime
 import json
 import numpy
 import os
-import requests
 import subprocess
 import sys
 import threading
 import time
+import Queue
 
 
 # my modules
 import audiorecorder
 import avrecorder
+import capture
+import encoders
+import jobs
+import journal
+import metrics
+import notifier
 import youtube_upload
 
 
 TEMPORARY_AUDIO_DIR = 'videos/temp_audio'
 TEMPORARY_VIDEO_DIR = 'videos/temp_video'
 FINAL_AV_DIR = 'videos/final'
+METRICS_DIR = 'videos/metrics'
+
+# how takes are encoded: frames piped into ffmpeg straight to the final
+# file (needs named pipes and ffmpeg on the PATH), or cv2.VideoWriter to a
+# temp file muxed on stop
+ENCODER_FFMPEG = 'ffmpeg'
+ENCODER_VIDEOWRITER = 'videowriter'
+ENCODER_BACKEND = (ENCODER_FFMPEG if hasattr(os, 'mkfifo') and encoders.find_ffmpeg()
+    else ENCODER_VIDEOWRITER)
+
+# what the camera delivers, what is recorded and what is shown on screen.
+# Recorded and preview frames are derived from the captured ones on the
+# capture thread, so the UI thread only ever sees preview sized frames.
+CAPTURE_PROFILE = capture.Profile(frameSize=(1280, 720), fps=30)
+RECORD_PROFILE = capture.Profile(frameSize=(1280, 720), fps=30)
+PREVIEW_PROFILE = capture.Profile(frameSize=(640, 360), fps=15)
+
+# where frames and audio come from: a camera index, capture.PATTERN_SOURCE
+# or a video file, and None for the microphone, audiorecorder.TONE_SOURCE
+# or a .wav file. Synthetic sources let the pipeline run without devices.
+VIDEO_SOURCE = os.environ.get('VIDEOBOOTH_VIDEO_SOURCE', 0)
+AUDIO_SOURCE = os.environ.get('VIDEOBOOTH_AUDIO_SOURCE')
+
+# H.264/AAC settings of the final file, one of encoders.ENCODE_PROFILES,
+# used by both backends
+ENCODE_PROFILE = encoders.ENCODE_PROFILES[os.environ.get('VIDEOBOOTH_ENCODE_PROFILE', 'youtube')]
+
+# longest fragment the ffmpeg backend writes while recording, stop only has
+# to finish the last one however long the take was. A fragment starts at
+# every keyframe, so with a profile's shorter GOP the fragments are that
+# long instead (0.5 s with 'youtube')
+MAX_FRAGMENT_SECONDS = 2
+
+# seconds of frames the encoder may fall behind before new ones are dropped
+ENCODER_QUEUE_SECONDS = 2
+
+# seconds of audio and video kept from before "Start Recording" is clicked
+PREROLL_SECONDS = 2
+
+# frames a frame may be off its slot before it's repeated or dropped
+SLOT_HYSTERESIS = 0.75
 
 PROMPTS = [
     'What is your hometown and what is your favorite thing about it?',
@@ -31,24 +79,210 @@ PROMPTS = [
 ]
 
 
+class Take():
+
+    # Everything about one recording. The device only ever records into its
+    # current take, so a finished take can wait for post-processing while
+    # the next one is being recorded.
+    def __init__(self, start_time, first_timestamp, profile, encoder_backend):
+
+        self.start_time = start_time
+        self.first_timestamp = first_timestamp
+        self.profile = profile
+        self.fps = profile.fps
+        self.frameSize = profile.frameSize
+        self.encoder_backend = encoder_backend
+
+        # frame counts and capture timestamps for video processing
+        self.frame_counts = 0
+        self.frame_timestamps = []
+        self.duplicated_frames = 0
+        self.skipped_frames = 0
+
+        # the audio's sample clock, the take's master clock once the
+        # microphone is attached, and where the take starts on it
+        self.clock = None
+        self.audio_start = None
+        self.audio_rate = None
+        self.first_media_time = None
+
+        # the camera's offset from the audio's frame grid, in frames
+        self.phase = None
+
+        self.metrics = metrics.PipelineMetrics()
+
+        self.video_out = None
+        self.microphone = None
+
+        # pre-roll frames the encoder thread writes ahead of the live ones
+        self.backlog = []
+
+        # set by the encoder thread once it released video_out
+        self.video_done = threading.Event()
+
+        self.set_filenames(start_time)
+
+
+    def set_filenames(self, start_time):
+
+        default_name = str(start_time)
+
+        # also the take's session id in the journal
+        self.name = default_name
+
+        self.temp_audio_filename = default_name
+        self.temp_audio_extension = '.wav'
+        self.temp_audio_filepath = os.path.join(TEMPORARY_AUDIO_DIR, 
+            self.temp_audio_filename + self.temp_audio_extension)
+ 
+        self.temp_video_filename = default_name
+        self.temp_video_extension = '.mp4'
+        self.temp_video_filepath = os.path.join(TEMPORARY_VIDEO_DIR, 
+            self.temp_video_filename + self.temp_video_extension)     
+
+        self.final_video_filepath = os.path.join(FINAL_AV_DIR,
+            default_name + '.mp4')
+
+        self.metrics_filepath = os.path.join(METRICS_DIR,
+            default_name + '.json')
+
+
+    def attach_audio(self, clock, start_position, rate):
+        self.clock = clock
+        self.audio_start = start_position
+        self.audio_rate = float(rate)
+
+
+    def media_time(self, timestamp):
+        """Where a frame captured at timestamp belongs in the take, in seconds
+
+        Counted in audio samples once the microphone is attached, so the
+        video follows the audio's start offset and its drift against the
+        capture clock. Before that, counted on the capture clock.
+        """
+
+        if self.clock is not None:
+            position = self.clock.position_at(timestamp)
+            if position is not None:
+                return (position - self.audio_start) / self.audio_rate
+        return timestamp - self.first_timestamp
+
+
+    def timescale(self):
+        """Factor the temp video's timestamps are scaled by when muxing
+
+        Frames were written on the fps grid of the audio's sample clock, so
+        the video normally matches the audio and is used as is. Should the
+        two still disagree by more than a frame, it is re-timed in the same
+        single ffmpeg pass that muxes the audio and encodes the final file.
+        """
+
+        video_duration = float(self.frame_counts) / self.fps
+        if self.frame_timestamps and video_duration:
+            captured_duration = self.media_time(self.frame_timestamps[-1]) + 1. / self.fps
+            if abs(captured_duration - video_duration) > 1. / self.fps:
+                return captured_duration / video_duration
+        return 1.
+
+
+    def sync_summary(self, audio_frames):
+        """Audio clock and A/V sync figures of the finished take"""
+
+        summary = {
+            'video_start_offset_ms': 1000. * (self.first_media_time or 0.),
+            'end_error_ms': 1000. * (float(self.frame_counts) / self.fps
+                - float(audio_frames) / (self.audio_rate or 1.)),
+        }
+        if self.clock is not None:
+            summary.update({
+                'audio_clock_rate': self.clock.rate(),
+                'drift_ppm': self.clock.drift_ppm(),
+                'clock_jitter_ms': 1000. * self.clock.jitter,
+            })
+        return summary
+
+
+
 class CameraDevice(QtWidgets.QWidget):
 
     newFrame = QtCore.pyqtSignal(numpy.ndarray)
     
-    def __init__(self):
+    def __init__(self, video_source=VIDEO_SOURCE, audio_source=AUDIO_SOURCE, scheduler=None,
+                 session_journal=None, upload_index=None):
         super(QtWidgets.QWidget, self).__init__()
 
-        self.fps = 10
-        self.frameSize = (640, 480) # video formats and sizes also depend and vary according to the camera used
+        self.capture_profile = CAPTURE_PROFILE
+        self.record_profile = RECORD_PROFILE
+        self.preview_profile = PREVIEW_PROFILE
+
+        # what is recorded, video formats and sizes also depend and vary
+        # according to the camera used
+        self.fps = self.record_profile.fps
+        self.frameSize = self.record_profile.frameSize
+        self.preroll_seconds = PREROLL_SECONDS
+        self.encoder_backend = ENCODER_BACKEND
+
+        # most recent (timestamp, frame) pairs while not recording
+        self.preroll = collections.deque(maxlen=int(self.preroll_seconds * self.fps))
         
-        # capture input from camera
-        self.cap = cv2.VideoCapture(0)
-        self.cap.set(3, 640)
-        self.cap.set(4, 480)
+        # preview frames are scaled and converted into these: one being
+        # filled, one queued, one shown by the widget and a spare. When none
+        # is free the preview skips a frame.
+        self.preview_pool = capture.FramePool(4)
+
+        # capture input from camera on its own thread, the preview only
+        # wants the latest frame while the encoder may lag a little
+        self.capture = capture.CaptureThread(video_source, self.capture_profile.frameSize,
+            self.capture_profile.fps)
+        self.preview_queue = self.capture.add_consumer(
+            capture.FrameQueue(1, drop=capture.DROP_OLDEST, on_drop=self._release_preview),
+            fps=self.preview_profile.fps, transform=self._preview_frame, name='preview')
+        self.encoder_queue = self.capture.add_consumer(
+            capture.FrameQueue(int(ENCODER_QUEUE_SECONDS * self.fps), drop=capture.DROP_NEWEST),
+            fps=self.fps, transform=self._record_frame, name='record')
+
+        # stage latencies between takes, each take brings its own collector
+        # so its numbers only cover that take
+        self.metrics = metrics.PipelineMetrics()
+        self.capture.metrics = self.metrics
+
+        # the take being recorded and the last one stopped
+        self.take = None
+        self.last_take = None
+
+        # stopped takes whose writer the encoder thread has yet to release
+        self.stopped_takes = []
+        self.processing_job = None
+
+        # background post-processing, shared with the window's uploads
+        self.scheduler = scheduler if scheduler is not None else jobs.JobScheduler()
+
+        # every take's progress, so a crash never loses track of one
+        self.journal = session_journal if session_journal is not None else journal.Journal()
+
+        # final files are fingerprinted as they are finished, so uploads can
+        # tell one they already sent
+        self.upload_index = (upload_index if upload_index is not None
+            else youtube_upload.UploadIndex())
+
+        # guards the take, the recording flag and the pre-roll against the
+        # encoder thread, never held while writing to a take
+        self.record_lock = threading.Lock()
+
+        # open the microphone once and keep it hot, takes only attach to it
+        self.audio_device = audiorecorder.AudioDevice(preroll_seconds=self.preroll_seconds,
+            source=audio_source)
+        self.audio_device.open()
 
         # don't record until user clicks start
         self.recording = False        
 
+        self.capture.start()
+
+        self.encoding = True
+        self.encoder_thread = threading.Thread(target=self._encode)
+        self.encoder_thread.daemon = True
+        self.encoder_thread.start()
 
         # start preview
         self.initUI()
@@ -58,135 +292,453 @@ class CameraDevice(QtWidgets.QWidget):
     def initUI(self):
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.nextFrameSlot)
-        self.timer.start(1000./self.fps)        
+        self.timer.start(1000./self.preview_profile.fps)        
 
 
     def nextFrameSlot(self):
-        ret, frame = self.cap.read() 
+        item = self.preview_queue.get_latest()
+        if item is None:
+            return
 
-        # fix color of what is saved
-        cv2.cvtColor(frame, cv2.COLOR_BGRA2RGBA, frame)
+        timestamp, frame = item
+        started = capture.monotonic()
+        self.metrics.record('preview_latency', started - timestamp)
 
-        # emit signal to update UI
-        self.newFrame.emit(frame)   
+        # emit signal to update UI, a connected widget takes the buffer
+        if self.receivers(self.newFrame) > 0:
+            self.newFrame.emit(frame)
+        else:
+            self.preview_pool.release(frame)
+        self.metrics.record('emit', capture.monotonic() - started)
 
-        
-        # write frames to file if recording
-        if self.recording:
-            self.video_out.write(frame)
 
-            # track frame counts for video processing
-            self.frame_counts += 1
+    def _release_preview(self, item):
+        timestamp, frame = item
+        self.preview_pool.release(frame)
 
 
-    def set_filenames(self, start_time):
+    def _preview_frame(self, frame):
+        """Scale a captured frame down to the preview size and convert it to RGB
 
-        default_name = str(start_time)
+        Runs on the capture thread, into a pooled buffer. Returns None, dropping
+        the frame, while every buffer is still held.
+        """
 
-        self.temp_audio_filename = default_name
-        self.temp_audio_extension = '.wav'
-        self.temp_audio_filepath = os.path.join(TEMPORARY_AUDIO_DIR, 
-            self.temp_audio_filename + self.temp_audio_extension)
- 
-        self.temp_video_filename = default_name
-        self.temp_video_extension = '.mp4'
-        self.temp_video_filepath = os.path.join(TEMPORARY_VIDEO_DIR, 
-            self.temp_video_filename + self.temp_video_extension)     
+        w, h = self.preview_profile.frameSize
+        preview = self.preview_pool.acquire((h, w, 3))
+        if preview is None:
+            return None
+        cv2.resize(frame, (w, h), preview, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(preview, cv2.COLOR_BGR2RGB, preview)
+        return preview
 
-        self.temp_video_filepath_2 = os.path.join(TEMPORARY_VIDEO_DIR,
-            self.temp_video_filename + '_2_' + self.temp_video_extension)   
 
-        self.final_video_filepath = os.path.join(FINAL_AV_DIR,
-            default_name + '.mp4')
+    def _record_frame(self, frame):
+        """Scale a captured frame to the recorded size, runs on the capture thread"""
+
+        w, h = self.frameSize
+        if frame.shape[1] == w and frame.shape[0] == h:
+            return frame
+        return cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+
+
+    def _encode(self):
+        """Encoder consumer, runs on its own thread for the app's lifetime
+
+        The only thread writing to and releasing a take's writer once it
+        records, outside record_lock, so a writer that blocks holds up
+        nothing but this thread and frames wait in the encoder queue.
+        """
+
+        while self.encoding:
+            item = self.encoder_queue.get(timeout=0.1)
+
+            with self.record_lock:
+                take = self.take if self.recording else None
+                if item is not None and take is None:
+                    self.preroll.append(item)
+                backlog = []
+                if take is not None:
+                    backlog, take.backlog = take.backlog, []
+                stopped, self.stopped_takes = self.stopped_takes, []
+
+            for timestamp, frame in backlog:
+                self._write_frame(take, timestamp, frame)
+
+            # write frames to file if recording
+            if item is not None and take is not None:
+                take.metrics.record('encoder_latency', capture.monotonic() - item[0])
+                self._write_frame(take, *item)
+
+            for take in stopped:
+                self._release_video(take)
+
+        for take in self.stopped_takes:
+            self._release_video(take)
+
+
+    def _release_video(self, take):
+        # a take stopped right after it started may still have pre-roll
+        for timestamp, frame in take.backlog:
+            self._write_frame(take, timestamp, frame)
+        take.backlog = []
+
+        take.video_out.release()
+
+        # the frames are all placed now, for re-muxing after a crash
+        self.journal.transition(take.name, timescale=take.timescale())
+        take.video_done.set()
+
+
+    def _write_frame(self, take, timestamp, frame):
+        """Write frame into the slot of the constant rate file matching timestamp
+
+        The file is written at exactly self.fps on the audio's sample clock.
+        Frames are locked to the phase of the take's first frame and go into
+        the next slot until they are SLOT_HYSTERESIS frames off it, so timing
+        jitter never flips them between neighbouring slots. Past that, a late
+        frame is repeated to fill the slots it missed and an early one is
+        dropped. The file then lines up with the audio, offset and drift
+        included, drift showing as an occasional single repeat or drop, and
+        needs no re-timing.
+        """
+
+        take.frame_timestamps.append(timestamp)
+
+        media_time = take.media_time(timestamp)
+        if take.first_media_time is None:
+            take.first_media_time = media_time
+
+        position = media_time * take.fps
+        if take.phase is None:
+            take.phase = position - round(position)
+        position -= take.phase
+
+        error = position - take.frame_counts
+        if error < SLOT_HYSTERESIS:
+            slot = take.frame_counts
+        else:
+            slot = int(round(position))
+
+        if error <= -SLOT_HYSTERESIS:
+            take.skipped_frames += 1
+            take.metrics.count('skipped_frames')
+            return
+
+        take.duplicated_frames += slot - take.frame_counts
+        take.metrics.count('duplicated_frames', slot - take.frame_counts)
+
+        started = capture.monotonic()
+        while take.frame_counts <= slot:
+            take.video_out.write(frame)
+
+            # track frame counts for video processing
+            take.frame_counts += 1
+        take.metrics.record('write', capture.monotonic() - started)
+
+        # how far from where the audio puts it the frame ends up
+        take.metrics.record('sync_error', abs(float(slot) / take.fps - media_time))
 
 
     def start(self):
-        """Start video and audio recording"""
+        """Start video and audio recording, returns False if it couldn't"""
 
         if self.recording:
-            return
+            return True
         
-        # reset frame counts for video processing
-        self.frame_counts = 0
+        # the encoder thread waits while the writer is set up, frames it
+        # misses meanwhile stay in the encoder queue. Returns as soon as the
+        # writers are open, the encoder and audio threads write the pre-roll.
+        with self.record_lock:
+
+            # the take starts with the oldest pre-roll frame, so nothing said
+            # while the writer is being created is lost
+            preroll_frames = list(self.preroll)
+            self.preroll.clear()
+            now = capture.monotonic()
+            if preroll_frames:
+                preroll_seconds = now - preroll_frames[0][0]
+            else:
+                preroll_seconds = 0
 
-        # reset start time for video processing
-        self.start_time = time.time()
+            # start time for video processing, frame slots are counted from
+            # the capture clock
+            take = Take(time.time() - preroll_seconds, now - preroll_seconds,
+                self.record_profile, self.encoder_backend)
 
-        # set filenames, must do before creating VideoWriter
-        self.set_filenames(self.start_time)
+            self.journal.begin(take.name, encoder_backend=take.encoder_backend,
+                temp_audio=take.temp_audio_filepath, temp_video=take.temp_video_filepath,
+                final_video=take.final_video_filepath)
 
-        # create object for video recording
-        self.fourcc = cv2.cv.FOURCC(*'mp4v') 
-        self.video_out = cv2.VideoWriter(self.temp_video_filepath, 
-            self.fourcc, self.fps, self.frameSize, True)
+            try:
+                self._open_take(take)
+            except Exception, e:
+                print "could not start recording %s: %r" % (take.name, e)
+                if take.video_out is not None:
+                    take.video_out.release()
+                self.journal.transition(take.name, journal.FAILED)
+                self.preroll.extend(preroll_frames)
+                return False
+            self.take = take
 
-        # audio recording
-        self.microphone = audiorecorder.AudioRecorder()
+            # fresh stage latencies for this take
+            self.metrics = take.metrics
+            self.capture.metrics = self.metrics
 
+            # frames are placed by the audio's sample count from here on
+            take.attach_audio(self.audio_device.clock, take.microphone.start_position,
+                self.audio_device.rate)
 
-        # start recording video
-        self.recording = True
+            take.backlog = preroll_frames
 
-        # start recording audio
-        self.microphone.start()
+            # start recording video
+            self.recording = True
 
         print 'Started video and audio recording'
+        return True
+
+
+    def _open_take(self, take):
+        """Create the take's writers and attach it to the microphone
+
+        Falls back to the VideoWriter backend when ffmpeg doesn't start.
+        Never waits on ffmpeg, which only opens its audio pipe once the
+        first frame arrived.
+        """
+
+        if take.encoder_backend == ENCODER_FFMPEG:
+            # frames and audio are encoded straight into the final file
+            try:
+                take.video_out = encoders.FFmpegPipeEncoder(take.final_video_filepath,
+                    take.fps, take.frameSize, self.audio_device.rate, self.audio_device.channels,
+                    fragment_seconds=MAX_FRAGMENT_SECONDS, profile=ENCODE_PROFILE)
+            except (OSError, IOError), e:
+                print "ffmpeg did not start (%s), recording with VideoWriter" % e
+                take.encoder_backend = ENCODER_VIDEOWRITER
+                self.journal.transition(take.name, encoder_backend=take.encoder_backend)
+
+        if take.encoder_backend == ENCODER_VIDEOWRITER:
+            # create object for video recording
+            self.fourcc = capture.fourcc('mp4v')
+            take.video_out = cv2.VideoWriter(take.temp_video_filepath, 
+                self.fourcc, take.fps, take.frameSize, True)
+            if not take.video_out.isOpened():
+                raise IOError("VideoWriter could not open " + take.temp_video_filepath)
+
+        # audio recording from the already open microphone, going back
+        # as far as the video does
+        take.microphone = audiorecorder.AudioRecorder(self.audio_device)
+
+        if take.encoder_backend == ENCODER_FFMPEG:
+            take.microphone.start(preroll_seconds=capture.monotonic() - take.first_timestamp,
+                writer=take.video_out.audio_writer)
+        else:
+            # spooled next to the temp video, so leftovers of a crash
+            # are found on the next start
+            take.microphone.start(preroll_seconds=capture.monotonic() - take.first_timestamp,
+                spool_dir=TEMPORARY_AUDIO_DIR)
+
     
+    def _stop_video(self):
+        """Stop recording, the encoder thread writes what it has and releases
+        the writer
+        """
+        with self.record_lock:
+            self.recording = False
+            self.stopped_takes.append(self.take)
+            self.take.metrics.stop()
+
+            self.metrics = metrics.PipelineMetrics()
+            self.capture.metrics = self.metrics
+
+
     def cancel(self):
-        self.recording = False
-        self.microphone.cancel()
+        if not self.recording:
+            return
+
+        take = self.take
+        self._stop_video()
+        take.microphone.cancel()
+        self.journal.transition(take.name, journal.CANCELLED)
+
+        self.scheduler.postprocess.submit_later(self._discard_take, take)
 
 
-    def stop(self):
-        """Stop video and audio recording"""
-        self.recording = False
-        self.microphone.stop(self.temp_audio_filepath)
+    def _discard_take(self, take):
+        take.video_done.wait()
+        if take.encoder_backend == ENCODER_FFMPEG:
+            take.video_out.wait()
+            remove_files([take.final_video_filepath])
+        else:
+            remove_files([take.temp_video_filepath])
+
+
+    def stop(self, wait=False):
+        """Stop video and audio recording, returns the post-processing job
+
+        wait -- process the files before returning instead of in the background
+        """
+        if not self.recording:
+            return None
+
+        take = self.last_take = self.take
+        self._stop_video()
+        take.microphone.stop(take.temp_audio_filepath)
+        self.journal.transition(take.name, journal.RECORDED)
 
         print 'Stopped video and audio recording'
 
-        # Stop audio and video recording
-        processing_thread = threading.Thread(target=self.process_AV_files)
-        processing_thread.start()
+        # the current take always gets processed, a full queue takes it as
+        # soon as there is room rather than dropping it or making the UI wait
+        self.processing_job = self.scheduler.postprocess.submit_later(self.process_AV_files,
+            take, priority=jobs.PRIORITY_HIGH)
+        if wait:
+            self.processing_job.wait()
+        return self.processing_job
         
 
 
 
-    def process_AV_files(self):
+    def process_AV_files(self, take):
 
-        filename = self.final_video_filepath
+        # all frames written and the writer released
+        take.video_done.wait()
+
+        filename = take.final_video_filepath
         
-        frame_counts = self.frame_counts
-        elapsed_time = time.time() - self.start_time
-        recorded_fps = frame_counts / elapsed_time
+        frame_counts = take.frame_counts
         print "total frames " + str(frame_counts)
-        print "elapsed time " + str(elapsed_time)
-        print "recorded fps " + str(recorded_fps)
-    
+        print "captured frames " + str(len(take.frame_timestamps))
+        print "duplicated frames " + str(take.duplicated_frames)
+        print "skipped frames " + str(take.skipped_frames)
+        print "duration " + str(float(frame_counts) / take.fps)
+
+        sync = take.sync_summary(take.microphone.frame_count)
+        print "audio clock drift %.1f ppm, video starts %.1f ms into the audio, ends %.1f ms off" % (
+            sync.get('drift_ppm', 0.), sync['video_start_offset_ms'], sync['end_error_ms'])
+
+        # the take's numbers are written even if post-processing blew up
+        processed = False
+        try:
+            started = capture.monotonic()
+            returncode = self._finish_AV_files(take)
+            take.metrics.record('postprocess', capture.monotonic() - started)
+            processed = self._session_processed(take.name, returncode,
+                [take.temp_audio_filepath, take.temp_video_filepath], take.final_video_filepath,
+                self._final_digest(take))
+        finally:
+            take.metrics.dump(take.metrics_filepath,
+                video_file=take.final_video_filepath,
+                encoder_backend=take.encoder_backend,
+                record_profile=take.profile._asdict(),
+                frames_written=frame_counts,
+                frames_captured=len(take.frame_timestamps),
+                audio_frames=take.microphone.frame_count,
+                audio_overruns=take.microphone.overruns,
+                processed=processed,
+                sync=sync)
+            print "metrics written to " + take.metrics_filepath
+
+        return take.final_video_filepath if processed else None
+
+
+    def _finish_AV_files(self, take):
+        """Write the take's final file, returns ffmpeg's exit code"""
+
+        if take.encoder_backend == ENCODER_FFMPEG:
+            # audio and video went into the final file while recording
+            print "FINISHING ENCODE"
+            return take.video_out.wait()
+
+        # merging audio and video signal
+        return self._mux(take.temp_audio_filepath, take.temp_video_filepath,
+            take.final_video_filepath, take.timescale())
+
+
+    def _final_digest(self, take):
+        """sha256 of the final file if it was computed while writing it"""
+        if take.encoder_backend == ENCODER_FFMPEG:
+            return take.video_out.sha256
+        return None
+
+
+    def _mux(self, audio_filepath, video_filepath, final_filepath, timescale):
+        print "MUXING"
+        cmd = encoders.mux_command(audio_filepath, video_filepath, final_filepath, timescale,
+            ENCODE_PROFILE)
+        print ' '.join(cmd)
+        return subprocess.call(cmd, **jobs.BACKGROUND_POPEN_KWARGS)
+
+
+    def _session_processed(self, session_id, returncode, temp_filepaths, final_filepath,
+                           digest=None):
+        """Journal the outcome of post-processing, the temp files go once it worked
+
+        The final file is fingerprinted with digest, or hashed if it's None.
+        Returns whether it worked.
+        """
+
+        if returncode == 0:
+            self.upload_index.fingerprint(final_filepath, digest)
+            self.journal.transition(session_id, journal.PROCESSED)
+            remove_files(temp_filepaths)
+            return True
+
+        print "post-processing %s failed with exit code %s" % (session_id, returncode)
+        self.journal.transition(session_id, journal.FAILED)
+        return False
+
+
+    def recover_session(self, session):
+        """Queue the final file of a session the last run stopped but never
+        finished, returns the job
+
+        Waits while the post-processing queue is full, so call it off the
+        GUI thread.
+        """
+        return self.scheduler.postprocess.submit(self._recover_AV_files, session,
+            priority=jobs.PRIORITY_LOW, block=True)
+
+
+    def _recover_AV_files(self, session):
 
-        # Merging audio and video signal
-
-        if abs(recorded_fps - 6) >= 0.01:    
-            # If the fps rate was higher/lower than expected, re-encode it to the expected
-            print "RE-ENCODING"
-            cmd = ''.join(["ffmpeg -r ", str(recorded_fps), " -i ", 
-                self.temp_video_filepath, " -pix_fmt yuv420p -r 6 ", self.temp_video_filepath_2])
-            print cmd
-            subprocess.call(cmd, shell=True)
-
-            print "MUXING"
-            cmd = ''.join(["ffmpeg -ac 2 -channel_layout stereo -i ", self.temp_audio_filepath, 
-                " -i ", self.temp_video_filepath_2, " -pix_fmt yuv420p ", self.final_video_filepath])
-            print cmd
-            subprocess.call(cmd, shell=True)
+        temp_filepaths = [session['temp_audio'], session['temp_video']]
+
+        if session['encoder_backend'] == ENCODER_FFMPEG:
+            # the fragments copied into the final file before the app died
+            # play, ffmpeg goes down with its output pipe
+            returncode = 0 if os.path.exists(session['final_video']) else 1
+        elif all(os.path.exists(filepath) for filepath in temp_filepaths):
+            # no timescale if the app died before the video was released
+            returncode = self._mux(session['temp_audio'], session['temp_video'],
+                session['final_video'], session['timescale'] or 1.)
         else:
-            print "Normal recording\nMuxing"
-            cmd = ''.join(["ffmpeg -ac 2 -channel_layout stereo -i ", self.temp_audio_filepath, 
-                " -i ", self.temp_video_filepath, " -pix_fmt yuv420p ", self.final_video_filepath])
-            subprocess.call(cmd, shell=True)
+            returncode = 1
+
+        if self._session_processed(session['id'], returncode, temp_filepaths,
+                session['final_video']):
+            return session['final_video']
 
 
     def get_final_filepath(self):
-        return self.final_video_filepath
+        """Final file of the last stopped take"""
+        return self.last_take.final_video_filepath
+
+
+    def get_metrics(self):
+        """Stage latencies, drop counts and jitter of the last stopped take"""
+        if self.last_take is None:
+            return None
+        return self.last_take.metrics.summary()
+
+
+    def release(self):
+        """Release camera and microphone when the app shuts down"""
+        self.timer.stop()
+        self.encoding = False
+        self.encoder_thread.join()
+        self.capture.stop()
+        self.audio_device.close()
 
 
 
@@ -198,14 +750,21 @@ class CameraWidget(QtWidgets.QWidget):
 
         self._frame = None
 
+        # the pooled array behind self._frame, held until the next frame
+        # replaces it and then given back to the pool
+        self._buffer = None
+
         self._cameraDevice = cameraDevice
         self._cameraDevice.newFrame.connect(self._onNewFrame)
     
 
-        w, h = self._cameraDevice.frameSize
+        w, h = self._cameraDevice.preview_profile.frameSize
         self.setMinimumSize(w, h)
         self.setMaximumSize(w, h)
 
+        # every paint covers the whole widget with the frame
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+
 
 
     @QtCore.pyqtSlot(numpy.ndarray)
@@ -213,8 +772,14 @@ class CameraWidget(QtWidgets.QWidget):
         """"Update UI preview with latest frame
         """
 
-        img = QtGui.QImage(frame, frame.shape[1], frame.shape[0], QtGui.QImage.Format_RGB888)
+        # wraps the buffer without copying, so give the stride explicitly
+        img = QtGui.QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0],
+            QtGui.QImage.Format_RGB888)
+        previous = self._buffer
+        self._buffer = frame
         self._frame = img
+        if previous is not None:
+            self._cameraDevice.preview_pool.release(previous)
         self.update()
 
 
@@ -231,8 +796,11 @@ class CameraWidget(QtWidgets.QWidget):
         if self._frame is None:
             return
 
+        started = capture.monotonic()
         painter = QtGui.QPainter(self)
         painter.drawImage(QtCore.QPoint(0, 0), self._frame)
+        painter.end()
+        self._cameraDevice.metrics.record('paint', capture.monotonic() - started)
 
 
 
@@ -247,9 +815,25 @@ class ControlWindow(QtWidgets.QWidget):
             self.setStyleSheet(f.read())
 
         
+        # background post-processing and uploads
+        self.scheduler = jobs.JobScheduler()
+        self.journal = journal.Journal()
+
+        # parallel YouTube uploads on one client, authorized ahead of the first
+        self.uploader = youtube_upload.YouTubeUploader()
+        self.upload_manager = youtube_upload.UploadManager(self.uploader)
+        self.upload_manager.submit(self.uploader.service, priority=jobs.PRIORITY_LOW)
+
         # create camera
-        self.cameraDevice = CameraDevice()
+        self.cameraDevice = CameraDevice(scheduler=self.scheduler, session_journal=self.journal,
+            upload_index=self.upload_manager.index)
         self.cameraWidget = CameraWidget(self.cameraDevice)
+
+        # uploads hold off while someone is recording
+        self.upload_manager.throttle.busy = lambda: self.cameraDevice.recording
+
+        # posts upload metadata to the Node server from its outbox
+        self.notifier = notifier.Notifier()
         
         # create layout w/ camera preview
         vertical_layout = QtWidgets.QVBoxLayout(self)
@@ -410,6 +994,23 @@ class ControlWindow(QtWidgets.QWidget):
         self.uploadStatusLabel = QtWidgets.QLabel("Nothing uploaded yet")
         vertical_layout.addWidget(self.uploadStatusLabel)
 
+        # (kerberos, handle) of this run's uploads, newest last
+        self.uploads = []
+        self.uploads_lock = threading.Lock()
+
+        self.cancel_upload_button = QtWidgets.QPushButton('Cancel last upload')
+        self.cancel_upload_button.clicked.connect(self.cancelUpload)
+        self.cancel_upload_button.setEnabled(False)
+        vertical_layout.addWidget(self.cancel_upload_button)
+
+        # background queue depths, refreshed by a timer
+        self.jobStatusLabel = QtWidgets.QLabel()
+        vertical_layout.addWidget(self.jobStatusLabel)
+
+        self.jobStatusTimer = QtCore.QTimer()
+        self.jobStatusTimer.timeout.connect(self.updateJobStatus)
+        self.jobStatusTimer.start(500)
+
 
         self.setLayout(vertical_layout)
         self.setWindowTitle('Video Booth')
@@ -418,6 +1019,126 @@ class ControlWindow(QtWidgets.QWidget):
 
         self.kerberos = ""
 
+        # pick up whatever the last run left unfinished
+        self.recoverSessions()
+
+
+
+    def recoverSessions(self):
+        """Re-queue the steps the journal has not seen complete and remove
+        temp files no session needs any more
+        """
+
+        pending = set()
+        backlog = []
+        for session in self.journal.incomplete():
+            if session['state'] == journal.RECORDING:
+                # the app died mid-take, the files were never finished
+                print "session %s was interrupted while recording" % session['id']
+                self.journal.transition(session['id'], journal.FAILED)
+                continue
+
+            if session['state'] == journal.RECORDED:
+                pending.update([session['temp_audio'], session['temp_video']])
+                backlog.append(session)
+            elif session['metadata'] is not None and session['youtube_id'] is not None:
+                # on YouTube already, only the Node server is missing
+                self._notify(session['id'], session['metadata'], session['youtube_id'])
+            elif session['metadata'] is not None:
+                backlog.append(session)
+
+        # a backlog may not fit the post-processing and upload queues at
+        # once, it is fed in from the background so the window comes up
+        # meanwhile
+        self.scheduler.uploads.submit(self._requeueSessions, backlog)
+
+        for directory in (TEMPORARY_AUDIO_DIR, TEMPORARY_VIDEO_DIR):
+            for filename in os.listdir(directory):
+                filepath = os.path.join(directory, filename)
+                if not filename.startswith('.') and filepath not in pending:
+                    print "removing leftover " + filepath
+                    os.remove(filepath)
+
+
+
+    def _requeueSessions(self, sessions):
+        for session in sessions:
+            processing_job = None
+            if session['state'] == journal.RECORDED:
+                print "re-processing session " + session['id']
+                processing_job = self.cameraDevice.recover_session(session)
+
+            if session['metadata'] is not None:
+                print "re-queueing upload of session " + session['id']
+                self._submitUpload(session['id'], session['final_video'], processing_job,
+                    session['metadata'], created=session['created'], block=True)
+
+
+    def _submitUpload(self, session_id, final_filepath, processing_job, metadata,
+                      priority=jobs.PRIORITY_NORMAL, created=None, block=False):
+        """Queue a session's file for YouTube, returns its handle"""
+
+        handle = self.upload_manager.upload_async(final_filepath, metadata['title'],
+            after=processing_job, priority=priority, created=created, block=block)
+        handle.add_done_callback(lambda handle: self._uploaded(session_id, metadata, handle))
+        with self.uploads_lock:
+            self.uploads.append((metadata['kerberos'], handle))
+        return handle
+
+
+    def _uploaded(self, session_id, metadata, handle):
+        """Journal a finished upload and tell the Node server, on the upload worker"""
+
+        if isinstance(handle.error, jobs.Cancelled):
+            self.journal.transition(session_id, journal.CANCELLED)
+            return
+        if handle.error is not None:
+            # stays journaled as pending, the next start tries again
+            return
+
+        self.journal.transition(session_id, journal.UPLOADED, youtube_id=handle.result)
+        self._notify(session_id, metadata, handle.result)
+
+
+    def cancelUpload(self):
+        with self.uploads_lock:
+            uploads = list(self.uploads)
+        for kerberos, handle in reversed(uploads):
+            if not handle.done.is_set():
+                handle.cancel()
+                return
+
+
+    def updateJobStatus(self):
+        self.jobStatusLabel.setText(" | ".join([self.scheduler.status(),
+            self.upload_manager.status(), self.notifier.status()]))
+
+        # the newest uploads, finished ones drop off after a few more
+        with self.uploads_lock:
+            self.uploads = [(kerberos, handle) for i, (kerberos, handle) in enumerate(self.uploads)
+                if not handle.done.is_set() or i >= len(self.uploads) - 3]
+            uploads = list(self.uploads)
+
+        lines = []
+        for kerberos, handle in uploads[-3:]:
+            state = handle.state()
+            if state == youtube_upload.UPLOADING and handle.progress() is not None:
+                state = "uploading %d%%" % (100 * handle.progress())
+            elif state == youtube_upload.UPLOADED:
+                state = "uploaded as " + handle.result
+            lines.append("Video for user %s: %s" % (kerberos, state))
+        if lines:
+            self.uploadStatusLabel.setText("\n".join(lines))
+        self.cancel_upload_button.setEnabled(any(not handle.done.is_set()
+            for kerberos, handle in uploads))
+
+        # backpressure: no new takes while post-processing is backed up
+        self.start_button.setEnabled(not self.scheduler.postprocess.full())
+
+
+    def closeEvent(self, e):
+        self.cameraDevice.release()
+        e.accept()
 
 
     def startRecording(self):
@@ -441,7 +1162,10 @@ class ControlWindow(QtWidgets.QWidget):
 
         
         # start recording
-        self.cameraDevice.start()
+        if not self.cameraDevice.start():
+            self.start_frame.show()
+            self.recording_frame.hide()
+            self.uploadStatusLabel.setText("Could not start recording, please try again")
 
     def startLoop(self):
         ## make this loop for 30 seconds
@@ -506,14 +1230,32 @@ class ControlWindow(QtWidgets.QWidget):
         
         
         else:
-            processing_thread = threading.Thread(target=self._upload)
-            processing_thread.start()
+            take = self.cameraDevice.last_take
+
+            # everything the upload and the Node server need, journaled so
+            # a crash can't lose the submission
+            metadata = {
+                'title': str(time.time()),
+                'kerberos': self.kerberos,
+                'recordingDate': datetime.datetime.now().strftime('%Y/%m/%d %H:%M'),
+                'newQuestion': self.prev_question,
+                'promptString': self.selected_prompt
+            }
+
+            try:
+                # the person at the booth goes ahead of any backlog
+                self._submitUpload(take.name, take.final_video_filepath,
+                    self.cameraDevice.processing_job, metadata, priority=jobs.PRIORITY_HIGH)
+            except Queue.Full:
+                self.uploadStatusLabel.setText("Upload queue is full, please try again in a moment")
+                return
+            self.journal.transition(take.name, metadata=metadata)
 
             self.start_frame.show()
             self.recording_frame.hide()
             self.submit_frame.hide()
 
-            self.uploadStatusLabel.setText("Uploaded video for user " + self.kerberos)
+            self.uploadStatusLabel.setText("Queued video for user " + self.kerberos)
             self.kerberos_inputbox.setText("")
             self.kerberosLabel.setStyleSheet('QLabel#KerberosLabel {color: black;}')
 
@@ -523,39 +1265,35 @@ class ControlWindow(QtWidgets.QWidget):
             # self.mitCourse_inputbox.setText("")
 
 
-    def _upload(self):
-        print 'The function _upload is called'
-        final_filepath = self.cameraDevice.get_final_filepath()
-        
-        title = str(time.time())
-
-
-        # upload video to youtube
-        youtubeId = youtube_upload.upload_video(final_filepath, title)
-
+    def _notify(self, session_id, metadata, youtubeId):
 
         # tell Node server that video was uploaded
 
         payload = {
             'youtubeId': youtubeId,
-            'title': title,
-            'kerberos': self.kerberos,
-            'recordingDate': datetime.datetime.now().strftime('%Y/%m/%d %H:%M'),
+            'title': metadata['title'],
+            'kerberos': metadata['kerberos'],
+            'recordingDate': metadata['recordingDate'],
             'upvotes': 0,
-            'newQuestion': self.prev_question,
-            'promptString': self.selected_prompt
+            'newQuestion': metadata['newQuestion'],
+            'promptString': metadata['promptString']
             # 'mitAffiliation': self.mitAffiliation,
             # 'mitCourse': self.mitCourse
         }
-        
-        payload = json.dumps(payload)
-        
-        url = 'https://mitpeople.herokuapp.com/upload'
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        r = requests.post(url, headers=headers, data=payload)
+
+        # the outbox is on disk, once it has the payload it gets sent
+        self.notifier.put(session_id, payload)
+        self.journal.transition(session_id, journal.NOTIFIED)
 
 
         
+def remove_files(filepaths):
+    for filepath in filepaths:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+
+
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
 
@@ -2,11 +2,15 @@
 
 
 # From https://developers.google.com/youtube/v3/guides/uploading_a_video
+import datetime
+import hashlib
 import httplib
 import httplib2
+import json
 import os
 import random
 import sys
+import threading
 import time
 
 from apiclient.discovery import build
@@ -18,6 +22,10 @@ from oauth2client.tools import argparser, run_flow
 
 from argparse import Namespace
 
+# my modules
+import jobs
+from files import read_json, write_json
+
 
 
 
@@ -83,6 +91,181 @@ https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
 
 VALID_PRIVACY_STATUSES = ("public", "private", "unlisted")
 
+# bytes sent per request of a resumable upload, a multiple of 256 KiB. Each
+# acknowledged chunk is progress that survives a dropped connection, -1
+# sends the whole file in one request.
+DEFAULT_CHUNKSIZE = 8 * 1024 * 1024
+
+# resumable session URIs of unfinished uploads, one file per upload, so a
+# restarted app continues where the last one stopped
+UPLOAD_SESSIONS_DIR = 'videos/upload_sessions'
+
+
+# the API's default daily quota, and what one videos.insert costs of it
+DAILY_QUOTA_UNITS = 10000
+VIDEO_INSERT_UNITS = 1600
+
+# quota units spent today, as far as this booth knows
+QUOTA_FILEPATH = 'videos/youtube_quota.json'
+
+# the quota resets at midnight Pacific time. Counted at UTC-8 all year, so
+# during daylight saving time the local reset comes an hour late, never early
+QUOTA_UTC_OFFSET = datetime.timedelta(hours=-8)
+
+# sha256 of every file uploaded and the video it became, so the same file
+# is never uploaded twice
+UPLOAD_INDEX_FILEPATH = 'videos/upload_index.json'
+
+# bytes read at a time when hashing a file
+HASH_CHUNKSIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class QuotaExceeded(UploadError):
+    pass
+
+
+
+class QuotaLedger():
+
+    # Local account of the day's API quota units, kept on disk so restarts
+    # don't forget what was spent. charge() refuses to go over daily_units.
+    def __init__(self, filepath=QUOTA_FILEPATH, daily_units=DAILY_QUOTA_UNITS):
+        self.filepath = filepath
+        self.daily_units = daily_units
+        self.lock = threading.Lock()
+
+        ledger = read_json(filepath, {'day': None, 'used': 0})
+        self.day = ledger['day']
+        self.used = ledger['used']
+
+
+    def _today(self):
+        return (datetime.datetime.utcnow() + QUOTA_UTC_OFFSET).strftime('%Y-%m-%d')
+
+
+    def charge(self, units):
+        """Spend units of today's quota, raises QuotaExceeded if there's not enough left"""
+
+        with self.lock:
+            today = self._today()
+            if self.day != today:
+                self.day = today
+                self.used = 0
+
+            if self.used + units > self.daily_units:
+                raise QuotaExceeded("%d of %d quota units used today, %d more needed" % (
+                    self.used, self.daily_units, units))
+
+            self.used += units
+            write_json(self.filepath, {'day': self.day, 'used': self.used})
+
+
+    def remaining(self):
+        with self.lock:
+            if self.day != self._today():
+                return self.daily_units
+            return self.daily_units - self.used
+
+
+class UploadIndex():
+
+    # Local index from the sha256 of a file's contents to the id of the
+    # video it was uploaded as, kept on disk like the quota. Fingerprints of
+    # the files themselves are remembered with their size and mtime, so a
+    # digest computed while a file was written is not computed again.
+    #
+    # claim() hands a digest to one uploader at a time: a second upload of
+    # the same contents waits for the first and gets its video id.
+    def __init__(self, filepath=UPLOAD_INDEX_FILEPATH):
+        self.filepath = filepath
+        self.condition = threading.Condition()
+        self.uploading = set()
+
+        # {digest: video id} and {filepath: {'size', 'mtime', 'sha256'}}
+        index = read_json(filepath, {'videos': {}, 'files': {}})
+        self.videos = index['videos']
+        self.files = index['files']
+
+
+    def _save(self):
+        # files that are gone can't come up again
+        self.files = dict((filepath, entry) for filepath, entry in self.files.items()
+            if os.path.exists(filepath))
+
+        write_json(self.filepath, {'videos': self.videos, 'files': self.files})
+
+
+    def fingerprint(self, filepath, digest=None):
+        """sha256 hex digest of filepath, remembered until the file changes
+
+        digest -- the digest, when computed while the file was written
+        """
+
+        stat = os.stat(filepath)
+        key = os.path.abspath(filepath)
+        with self.condition:
+            entry = self.files.get(key)
+            if digest is None and entry is not None and (
+                    entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime):
+                return entry['sha256']
+
+        if digest is None:
+            digest = hash_file(filepath)
+
+        with self.condition:
+            self.files[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+            self._save()
+        return digest
+
+
+    def claim(self, digest):
+        """Video id of digest if it was uploaded, otherwise None and the
+        caller uploads it and has to release() it
+        """
+
+        with self.condition:
+            while digest in self.uploading:
+                self.condition.wait()
+
+            videoid = self.videos.get(digest)
+            if videoid is None:
+                self.uploading.add(digest)
+            return videoid
+
+
+    def release(self, digest, videoid=None):
+        """End the claim on digest, with the video id if the upload made it"""
+
+        with self.condition:
+            self.uploading.discard(digest)
+            if videoid is not None:
+                self.videos[digest] = videoid
+                self._save()
+            self.condition.notify_all()
+
+
+    def __len__(self):
+        with self.condition:
+            return len(self.videos)
+
+
+
+def hash_file(filepath):
+    """sha256 hex digest of filepath, read a chunk at a time"""
+
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNKSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
 
 def get_authenticated_service(args):
     flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
@@ -99,7 +282,199 @@ def get_authenticated_service(args):
         http=credentials.authorize(httplib2.Http()))
 
 
-def initialize_upload(youtube, options):
+def default_args(**kwargs):
+    """Namespace of the booth's upload options, as the sample's argparser would give"""
+
+    args = Namespace(
+        file=None, title=None, privacyStatus='unlisted',
+        auth_host_name='localhost', auth_host_port=[8080, 8090], category='22', 
+        description='', keywords='', logging_level='ERROR', 
+        noauth_local_webserver=False, playlist='testlist')
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+class YouTubeUploader():
+
+    # Long-lived uploader. Credentials are read once and shared, each upload
+    # thread keeps its own built youtube client on its own httplib2.Http,
+    # whose keep-alive connections are reused from one upload to the next.
+    #
+    # The access token is refreshed before an upload whenever it would
+    # expire within refresh_margin seconds, so it never runs out mid-upload.
+    #
+    # Files go up in chunks of chunksize bytes. The session URI of each
+    # upload is kept in sessions_dir until it finishes, so an upload cut off
+    # by a crash or a network blip continues from the last acknowledged byte.
+    #
+    # With a bucket (a jobs.TokenBucket) every request to the API takes a
+    # token first, with a quota (a QuotaLedger) every new upload is charged
+    # to the day's quota before it starts and with a throttle (an
+    # UploadThrottle) chunks are paced by it.
+    #
+    # Files are looked up in index (an UploadIndex) by their contents, one
+    # uploaded before returns its video id without being sent again.
+    def __init__(self, args=None, refresh_margin=600, chunksize=DEFAULT_CHUNKSIZE,
+                 sessions_dir=UPLOAD_SESSIONS_DIR, bucket=None, quota=None, throttle=None,
+                 index=None):
+        self.args = args if args is not None else default_args()
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self.chunksize = chunksize
+        self.sessions_dir = sessions_dir
+        self.bucket = bucket
+        self.quota = quota
+        self.throttle = throttle
+        self.index = index if index is not None else UploadIndex()
+
+        self.credentials = None
+        self.lock = threading.Lock()
+
+        # per thread (http, youtube)
+        self.local = threading.local()
+
+
+    def _credentials(self):
+        if self.credentials is None:
+            flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
+                scope=YOUTUBE_UPLOAD_SCOPE,
+                message=MISSING_CLIENT_SECRETS_MESSAGE)
+
+            self.storage = Storage("%s-oauth2.json" % sys.argv[0])
+            credentials = self.storage.get()
+
+            if credentials is None or credentials.invalid:
+                credentials = run_flow(flow, self.storage, self.args)
+            self.credentials = credentials
+        return self.credentials
+
+
+    def _refresh_if_expiring(self, http):
+        credentials = self.credentials
+        expiry = credentials.token_expiry
+        if credentials.access_token_expired or (expiry is not None and
+                expiry - datetime.datetime.utcnow() < self.refresh_margin):
+            print "refreshing YouTube access token"
+            credentials.refresh(http)
+
+
+    def service(self):
+        """The calling thread's youtube client, with a fresh enough token"""
+
+        with self.lock:
+            self._credentials()
+
+            if getattr(self.local, 'youtube', None) is None:
+                self.local.http = httplib2.Http()
+                self.local.youtube = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
+                    http=self.credentials.authorize(self.local.http))
+
+            # refreshed on a connection of its own, the client's http is
+            # wrapped by the credentials
+            self._refresh_if_expiring(httplib2.Http())
+
+        return self.local.youtube
+
+
+    def _session_filepath(self, filepath):
+        return os.path.join(self.sessions_dir, os.path.basename(filepath) + '.json')
+
+
+    def _load_session(self, filepath):
+        """Session URI of an unfinished upload of this very file, or None"""
+
+        session = read_json(self._session_filepath(filepath))
+        if session is None:
+            return None
+
+        # a file changed since is uploaded from scratch
+        stat = os.stat(filepath)
+        if session['size'] != stat.st_size or session['mtime'] != stat.st_mtime:
+            self._clear_session(filepath)
+            return None
+        return session['uri']
+
+
+    def _save_session(self, filepath, uri):
+        stat = os.stat(filepath)
+        session_filepath = self._session_filepath(filepath)
+
+        # a crash never leaves half a file
+        write_json(session_filepath, {'uri': uri, 'size': stat.st_size, 'mtime': stat.st_mtime})
+
+
+    def _clear_session(self, filepath):
+        session_filepath = self._session_filepath(filepath)
+        if os.path.exists(session_filepath):
+            os.remove(session_filepath)
+
+
+    def upload(self, filepath, title, progress=None, cancelled=None):
+        """Upload filepath as an unlisted video, returns its id
+
+        progress -- called with (bytes sent, total bytes) after every chunk
+        cancelled -- checked before every chunk, the upload stops with
+                     jobs.Cancelled once it returns True
+
+        Raises UploadError when the upload can't be completed.
+        """
+
+        if not os.path.exists(filepath):
+            raise UploadError("No such file %s" % filepath)
+
+        digest = self.index.fingerprint(filepath)
+        videoid = self.index.claim(digest)
+        if videoid is not None:
+            print "%s was uploaded before as %s" % (filepath, videoid)
+            return videoid
+
+        try:
+            videoid = self._upload(filepath, title, progress, cancelled)
+        finally:
+            self.index.release(digest, videoid)
+        return videoid
+
+
+    def _upload(self, filepath, title, progress, cancelled):
+        options = default_args(file=filepath, title=title,
+            privacyStatus=self.args.privacyStatus)
+
+        youtube = self.service()
+        request = insert_request(youtube, options, self.chunksize)
+
+        uri = self._load_session(filepath)
+        if uri is not None:
+            print "Resuming upload of %s" % filepath
+            request.resumable_uri = uri
+
+            # the next chunk first asks the server how much it already has
+            request._in_error_state = True
+        elif self.quota is not None:
+            # only starting a session inserts a video
+            self.quota.charge(VIDEO_INSERT_UNITS)
+
+        before_request = self.bucket.take if self.bucket is not None else None
+        try:
+            videoid = resumable_upload(request, progress,
+                lambda uri: self._save_session(filepath, uri), before_request, self.throttle,
+                cancelled)
+        except jobs.Cancelled:
+            # not to be resumed
+            self._clear_session(filepath)
+            raise
+        except HttpError, e:
+            if uri is not None and e.resp.status in (404, 410):
+                # the session expired, start a new one
+                self._clear_session(filepath)
+                return self._upload(filepath, title, progress, cancelled)
+            raise UploadError("An HTTP error %d occurred:\n%s" % (e.resp.status, e.content))
+
+        self._clear_session(filepath)
+        return videoid
+
+
+
+def insert_request(youtube, options, chunksize=-1):
     tags = None
     if options.keywords:
         tags = options.keywords.split(",")
@@ -117,7 +492,7 @@ def initialize_upload(youtube, options):
     )
 
     # Call the API's videos.insert method to create and upload the video.
-    insert_request = youtube.videos().insert(
+    return youtube.videos().insert(
         part=",".join(body.keys()),
         body=body,
         # The chunksize parameter specifies the size of each chunk of data, in
@@ -131,30 +506,72 @@ def initialize_upload(youtube, options):
         # practice, but if you're using Python older than 2.6 or if you're
         # running on App Engine, you should set the chunksize to something like
         # 1024 * 1024 (1 megabyte).
-        media_body=MediaFileUpload(options.file, chunksize=-1, resumable=True)
+        media_body=MediaFileUpload(options.file, chunksize=chunksize, resumable=True)
     )
 
-    return resumable_upload(insert_request)
+
+def initialize_upload(youtube, options):
+    return resumable_upload(insert_request(youtube, options))
 
 # This method implements an exponential backoff strategy to resume a
 # failed upload.
-def resumable_upload(insert_request):
+#
+# progress is called with (bytes sent, total bytes) after every chunk,
+# on_session with the session URI once the server handed one out and
+# before_request, which may block, before every request. A throttle (an
+# UploadThrottle) paces the chunks. Raises UploadError when it gives up and
+# jobs.Cancelled once cancelled() returns True.
+def resumable_upload(insert_request, progress=None, on_session=None, before_request=None,
+                     throttle=None, cancelled=None):
     response = None
     error = None
     retry = 0
+    session_uri = None
     while response is None:
+        error = None
         try:
+            if cancelled is not None and cancelled():
+                raise jobs.Cancelled()
+            if throttle is not None:
+                throttle.wait(cancelled)
+            if before_request is not None:
+                before_request()
+
             print "Uploading file..."
+            sent = insert_request.resumable_progress
+            started = time.time()
             status, response = insert_request.next_chunk()
+
+            if throttle is not None:
+                acknowledged = status.resumable_progress if status is not None else (
+                    insert_request.resumable.size() if response is not None else sent)
+                throttle.sent(acknowledged - sent, time.time() - started)
+
+            if on_session is not None and insert_request.resumable_uri != session_uri:
+                session_uri = insert_request.resumable_uri
+                on_session(session_uri)
+
+            if status is not None:
+                # a chunk got through, the retries start over
+                retry = 0
+                if progress is not None:
+                    progress(status.resumable_progress, status.total_size)
+
+            if response is None:
+                continue
+
             if 'id' in response:
                 print "Video id '%s' was successfully uploaded." % response['id']
 
+                if progress is not None:
+                    size = insert_request.resumable.size()
+                    progress(size, size)
                 return response['id']
                 # TODO: add video id to correct playlist here
                 #   playlists.add_video_to_existing_playlist()
 
             else:
-                exit("The upload failed with an unexpected response: %s" % response)
+                raise UploadError("The upload failed with an unexpected response: %s" % response)
         except HttpError, e:
             if e.resp.status in RETRIABLE_STATUS_CODES:
                 error = "A retriable HTTP error %d occurred:\n%s" % (e.resp.status, e.content)
@@ -167,7 +584,11 @@ def resumable_upload(insert_request):
             print error
             retry += 1
             if retry > MAX_RETRIES:
-                exit("No longer attempting to retry.")
+                raise UploadError("No longer attempting to retry.")
+
+            # find out what the server has before sending more
+            if insert_request.resumable_uri is not None:
+                insert_request._in_error_state = True
 
             max_sleep = 2 ** retry
             sleep_seconds = random.random() * max_sleep
@@ -175,29 +596,219 @@ def resumable_upload(insert_request):
             time.sleep(sleep_seconds)
 
 
-def upload_video(filepath, title):
+class UploadThrottle():
+
+    # Paces the chunks of all uploads by what the booth is doing. While
+    # busy() is true, e.g. while a take is being recorded, chunks go out at
+    # busy_rate bytes per second on average, or not at all with busy_rate 0,
+    # so uploads don't take the uplink and CPU away from capture. Otherwise
+    # they go at full rate.
+    #
+    # Measured throughput is a moving average over the chunks sent.
+    def __init__(self, busy=None, busy_rate=0, poll_interval=0.25):
+        self.busy = busy if busy is not None else (lambda: False)
+        self.busy_rate = busy_rate
+        self.poll_interval = poll_interval
+
+        # when the next chunk may go while busy
+        self.next_send = 0.
+        self.lock = threading.Lock()
+
+        self.bytes_sent = 0
+        self.seconds_sending = 0.
+        self.rate = None
+
+
+    def wait(self, cancelled=None):
+        """Block until the next chunk may be sent
+
+        cancelled -- checked while waiting, raises jobs.Cancelled once it
+                     returns True
+        """
+
+        while self.busy():
+            if cancelled is not None and cancelled():
+                raise jobs.Cancelled()
+            if self.busy_rate:
+                with self.lock:
+                    delay = self.next_send - time.time()
+                if delay <= 0:
+                    return
+                time.sleep(min(delay, self.poll_interval))
+            else:
+                time.sleep(self.poll_interval)
 
-    
-    args = Namespace(
-        file=filepath, title=title, privacyStatus='unlisted',
-        auth_host_name='localhost', auth_host_port=[8080, 8090], category='22', 
-        description='', keywords='', logging_level='ERROR', 
-        noauth_local_webserver=False, playlist='testlist')
 
-    print args.file
-    
-    if not os.path.exists(args.file):
-        exit("Please specify a valid file using the --file= parameter.")
+    def sent(self, nbytes, seconds):
+        """Account for a chunk of nbytes that took seconds to send"""
 
-    youtube = get_authenticated_service(args)
+        with self.lock:
+            self.bytes_sent += nbytes
+            self.seconds_sending += seconds
+            if seconds > 0 and nbytes > 0:
+                rate = nbytes / seconds
+                self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
 
+            if self.busy_rate:
+                self.next_send = max(self.next_send, time.time()) + float(nbytes) / self.busy_rate
 
-    print 'got authenticated service'
-    try:
-        videoid = initialize_upload(youtube, args)
-        return videoid
-    except HttpError, e:
-        print "An HTTP error %d occurred:\n%s" % (e.resp.status, e.content)
+
+    def throughput(self):
+        """Recent bytes per second while sending, None before the first chunk"""
+        return self.rate
+
+
+    def status(self):
+        if self.rate is None:
+            state = "no uploads yet"
+        else:
+            state = "%.0f kB/s" % (self.rate / 1e3)
+        if self.busy():
+            state += ", paused while recording" if not self.busy_rate else ", throttled while recording"
+        return state
+
+
+
+# states of an UploadHandle
+WAITING = 'waiting'         # for the file to be finished
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class UploadHandle(jobs.Job):
+
+    # Future of one upload, as returned by UploadManager.upload_async. The
+    # video id is its result once done, progress() tells how far it got and
+    # cancel() stops it, also in the middle of the file.
+    def __init__(self, manager, filepath, title, after, priority):
+        jobs.Job.__init__(self, 'upload', self._upload, (), {}, priority)
+        self.manager = manager
+        self.filepath = filepath
+        self.title = title
+        self.after = after
+
+        self.started = False
+        self.sent = 0
+        self.total = None
+
+
+    def _upload(self):
+        if self.after is not None and (self.after.error is not None or self.after.result is None):
+            raise UploadError("%s was never finished" % self.filepath)
+
+        self.started = True
+        return self.manager.upload(self.filepath, self.title, self._progress,
+            lambda: self.cancelled)
+
+
+    def _progress(self, sent, total):
+        self.sent = sent
+        self.total = total
+
+
+    def progress(self):
+        """Fraction of the file the server acknowledged, None before the first chunk"""
+        if not self.total:
+            return None
+        return float(self.sent) / self.total
+
+
+    def state(self):
+        if self.done.is_set():
+            if isinstance(self.error, jobs.Cancelled):
+                return CANCELLED
+            return FAILED if self.error is not None else UPLOADED
+        if self.started:
+            return UPLOADING
+        if self.after is not None and not self.after.done.is_set():
+            return WAITING
+        return QUEUED
+
+
+    def video_id(self, timeout=None):
+        """Block until done, returns the video id or None if it didn't make it"""
+        self.wait(timeout)
+        return self.result
+
+
+
+class UploadManager(jobs.JobQueue):
+
+    # Runs uploads on a pool of parallel workers. Waiting uploads go by
+    # priority and then by age, so a backlog left from when the booth was
+    # offline drains oldest first. All workers share one uploader, one
+    # request rate limit, one quota ledger and the uploader's index.
+    #
+    # upload_async() queues a file and returns an UploadHandle right away.
+    # Other jobs can be submitted like on any JobQueue and call upload()
+    # from their worker thread.
+    #
+    # Chunks are paused while busy() is true, or paced at busy_rate bytes
+    # per second when that is given, see UploadThrottle.
+    def __init__(self, uploader=None, workers=3, maxsize=16,
+                 requests_per_second=5, burst=10, quota=None, busy=None, busy_rate=0):
+        jobs.JobQueue.__init__(self, 'youtube', workers, maxsize)
+
+        self.bucket = jobs.TokenBucket(requests_per_second, burst)
+        self.quota = quota if quota is not None else QuotaLedger()
+        self.throttle = UploadThrottle(busy, busy_rate)
+
+        self.uploader = uploader if uploader is not None else YouTubeUploader()
+        self.uploader.bucket = self.bucket
+        self.uploader.quota = self.quota
+        self.uploader.throttle = self.throttle
+        self.index = self.uploader.index
+
+
+    def upload(self, filepath, title, progress=None, cancelled=None):
+        return self.uploader.upload(filepath, title, progress, cancelled)
+
+
+    def upload_async(self, filepath, title, after=None, priority=jobs.PRIORITY_NORMAL,
+                     created=None, block=False):
+        """Queue filepath for upload, returns its UploadHandle
+
+        after -- job that writes the file, the upload is queued once it ran
+                 and fails if it didn't return anything
+        created -- time.time() the file came about, for ordering by age
+
+        Raises Queue.Full like submit() when queued right away, that is
+        without after or with an after that already ran.
+        """
+
+        handle = UploadHandle(self, filepath, title, after, priority)
+        if after is None or after.done.is_set():
+            self.put(handle, created, block)
+        else:
+            # queued once the other job ran. The callback may still run on
+            # this thread if it finishes meanwhile, so it never waits for room
+            after.add_done_callback(lambda job: self.put_later(handle, created))
+        return handle
+
+
+    def status(self):
+        return "YouTube: %d running, %d queued, %s, %d quota units left" % (
+            self.running, self.depth(), self.throttle.status(), self.quota.remaining())
+
+
+
+# shared by every upload_video call
+uploader = None
+uploader_lock = threading.Lock()
+
+
+def upload_video(filepath, title):
+    global uploader
+
+    print filepath
+
+    with uploader_lock:
+        if uploader is None:
+            uploader = YouTubeUploader()
+    return uploader.upload(filepath, title)
 
 
 
@@ -226,4 +837,6 @@ if __name__ == '__main__':
     try:
      initialize_upload(youtube, args)
     except HttpError, e:
-     print "An HTTP error %d occurred:\n%s" % (e.resp.status, e.content)
\ No newline at end of file
+     print "An HTTP error %d occurred:\n%s" % (e.resp.status, e.content)
+    except UploadError, e:
+     exit(str(e))
\ No newline at end of file